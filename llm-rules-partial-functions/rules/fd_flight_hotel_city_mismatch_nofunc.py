@@ -1,9 +1,53 @@
 from typing import Dict, Any, List, Optional, Set, Tuple
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from operator import attrgetter, itemgetter
 from expensecbr.base import TrajectoryEvent, HotelEvent, FlightEvent, RailwayEvent
 from expensecbr.fde import create_time_window_rule
 
+# A single point on a user's location timeline
+TimelineEntry = namedtuple("TimelineEntry", "time city kind event_id event")
+
+# Display format for times in alerts; detection results keep raw datetimes
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+# Bucket name for each event class this rule uses; other classes map to ""
+_EVENT_BUCKETS = ((HotelEvent, "hotel"), (FlightEvent, "flight"), (RailwayEvent, "rail"))
+_bucket_by_type = {}
+
+
+def _resolve_bucket(event_type):
+    """Resolve and cache the bucket name for an event class, honouring subclasses"""
+    bucket = next((name for cls, name in _EVENT_BUCKETS if issubclass(event_type, cls)), "")
+    _bucket_by_type[event_type] = bucket
+    return bucket
+
+
+def _start_time(event):
+    """Exact start time if known, otherwise the earliest possible start"""
+    time_window = event.time_window
+    return time_window.exact_start_time or time_window.earliest_start
+
+
+def _end_time(event):
+    """Exact end time if known, otherwise the latest possible end"""
+    time_window = event.time_window
+    return time_window.exact_end_time or time_window.latest_end
+
+
+def _index_events(events):
+    """Return an event_id -> event dict; the first event wins when IDs repeat, like next()"""
+    event_index = {}
+    for event in events:
+        event_index.setdefault(event.event_id, event)
+    return event_index
+
+
+def _format_time(value):
+    """Format a detection timestamp for display; non-datetime values pass through unchanged"""
+    return value.strftime(TIME_FORMAT) if isinstance(value, datetime) else value
+
+
 def detect_flight_hotel_city_mismatch(rule, events, context):
     """
     Detect mismatches between flight destinations and hotel stay cities.
@@ -15,27 +59,43 @@ def detect_flight_hotel_city_mismatch(rule, events, context):
     if not events:
         return False
     
-    # Group events by user_id
-    events_by_user = {}
+    # Group events by user_id and split them by type in a single pass
+    events_by_user = defaultdict(lambda: {"hotel": [], "flight": [], "rail": []})
     for event in events:
-        if event.user_id not in events_by_user:
-            events_by_user[event.user_id] = []
-        events_by_user[event.user_id].append(event)
+        user_buckets = events_by_user[event.user_id]
+        event_type = type(event)
+        bucket = _bucket_by_type.get(event_type)
+        if bucket is None:
+            bucket = _resolve_bucket(event_type)
+        if bucket:
+            user_buckets[bucket].append(event)
     
     fraud_instances = []
     
-    for user_id, user_events in events_by_user.items():
-        # Filter for hotel and flight events
-        hotel_events = [e for e in user_events if isinstance(e, HotelEvent)]
-        flight_events = [e for e in user_events if isinstance(e, FlightEvent)]
+    for user_id, user_buckets in events_by_user.items():
+        hotel_events = user_buckets["hotel"]
+        flight_events = user_buckets["flight"]
         
         # Skip if user doesn't have both hotel and flight events
         if not hotel_events or not flight_events:
             continue
         
         # Sort events by time
-        hotel_events.sort(key=lambda e: e.time_window.earliest_start)
-        flight_events.sort(key=lambda e: e.time_window.earliest_start)
+        sort_key = attrgetter("time_window.earliest_start")
+        hotel_events.sort(key=sort_key)
+        flight_events.sort(key=sort_key)
+        
+        # A mismatch needs at least two distinct cities among flight arrivals and hotels
+        cities = set()
+        for flight in flight_events:
+            arrival_location = getattr(flight, "arrival_location", None)
+            if arrival_location and arrival_location.city:
+                cities.add(arrival_location.city)
+        for hotel in hotel_events:
+            if hotel.location and hotel.location.city:
+                cities.add(hotel.location.city)
+        if len(cities) <= 1:
+            continue
         
         # Create a timeline of user's locations
         timeline = []
@@ -46,130 +106,84 @@ def detect_flight_hotel_city_mismatch(rule, events, context):
             departure_location = getattr(flight, "departure_location", None)
             
             if arrival_location and arrival_location.city:
-                arrival_time = flight.time_window.exact_end_time or flight.time_window.latest_end
-                timeline.append({
-                    "time": arrival_time,
-                    "city": arrival_location.city,
-                    "type": "flight_arrival",
-                    "event_id": flight.event_id,
-                    "event": flight
-                })
+                arrival_time = _end_time(flight)
+                timeline.append(TimelineEntry(
+                    arrival_time, arrival_location.city, "flight_arrival", flight.event_id, flight
+                ))
             
             if departure_location and departure_location.city:
-                departure_time = flight.time_window.exact_start_time or flight.time_window.earliest_start
-                timeline.append({
-                    "time": departure_time,
-                    "city": departure_location.city,
-                    "type": "flight_departure",
-                    "event_id": flight.event_id,
-                    "event": flight
-                })
+                departure_time = _start_time(flight)
+                timeline.append(TimelineEntry(
+                    departure_time, departure_location.city, "flight_departure", flight.event_id, flight
+                ))
         
         # Add hotel stays to timeline
         for hotel in hotel_events:
             if not hotel.location or not hotel.location.city:
                 continue
                 
-            check_in_time = hotel.time_window.exact_start_time or hotel.time_window.earliest_start
-            check_out_time = hotel.time_window.exact_end_time or hotel.time_window.latest_end
+            check_in_time = _start_time(hotel)
+            check_out_time = _end_time(hotel)
             
-            timeline.append({
-                "time": check_in_time,
-                "city": hotel.location.city,
-                "type": "hotel_check_in",
-                "event_id": hotel.event_id,
-                "event": hotel
-            })
+            timeline.append(TimelineEntry(
+                check_in_time, hotel.location.city, "hotel_check_in", hotel.event_id, hotel
+            ))
             
-            timeline.append({
-                "time": check_out_time,
-                "city": hotel.location.city,
-                "type": "hotel_check_out",
-                "event_id": hotel.event_id,
-                "event": hotel
-            })
+            timeline.append(TimelineEntry(
+                check_out_time, hotel.location.city, "hotel_check_out", hotel.event_id, hotel
+            ))
         
         # Add railway events to timeline
-        railway_events = [e for e in user_events if isinstance(e, RailwayEvent)]
-        for railway in railway_events:
+        for railway in user_buckets["rail"]:
             from_location = getattr(railway, "from_location", None)
             to_location = getattr(railway, "to_location", None)
             
             if from_location and from_location.city:
-                departure_time = railway.time_window.exact_start_time or railway.time_window.earliest_start
-                timeline.append({
-                    "time": departure_time,
-                    "city": from_location.city,
-                    "type": "railway_departure",
-                    "event_id": railway.event_id,
-                    "event": railway
-                })
+                departure_time = _start_time(railway)
+                timeline.append(TimelineEntry(
+                    departure_time, from_location.city, "railway_departure", railway.event_id, railway
+                ))
             
             if to_location and to_location.city:
-                arrival_time = railway.time_window.exact_end_time or railway.time_window.latest_end
-                timeline.append({
-                    "time": arrival_time,
-                    "city": to_location.city,
-                    "type": "railway_arrival",
-                    "event_id": railway.event_id,
-                    "event": railway
-                })
+                arrival_time = _end_time(railway)
+                timeline.append(TimelineEntry(
+                    arrival_time, to_location.city, "railway_arrival", railway.event_id, railway
+                ))
         
         # Sort timeline by time
-        timeline.sort(key=lambda x: x["time"])
+        timeline.sort(key=itemgetter(0))
         
         # Check for mismatches between flight arrivals and subsequent hotel check-ins
-        for i in range(len(timeline) - 1):
-            current = timeline[i]
-            next_event = timeline[i + 1]
-            
-            # Check if current event is a flight arrival and next event is a hotel check-in
-            if current["type"] == "flight_arrival" and next_event["type"] == "hotel_check_in":
-                # Skip if the cities match
-                if current["city"] == next_event["city"]:
-                    continue
+        previous = None
+        for current in timeline:
+            # Check if previous event is a flight arrival and current event is a hotel check-in.
+            # The two are adjacent on the sorted timeline, so no transport arrival lies between
+            # them to explain a change of city
+            if (previous is not None and previous.kind == "flight_arrival"
+                    and current.kind == "hotel_check_in"
+                    and previous.city != current.city):
+                flight_event = previous.event
+                hotel_event = current.event
+                flight_arrival_time = previous.time
+                hotel_check_in_time = current.time
                 
-                # Cities don't match - check if there's a valid connection
-                flight_arrival_city = current["city"]
-                hotel_city = next_event["city"]
-                flight_arrival_time = current["time"]
-                hotel_check_in_time = next_event["time"]
+                # Calculate time difference between flight arrival and hotel check-in
+                time_diff_hours = (hotel_check_in_time - flight_arrival_time).total_seconds() / 3600
                 
-                # Look for any transportation events between flight arrival and hotel check-in
-                has_connection = False
-                for j in range(i + 1, len(timeline)):
-                    intermediate = timeline[j]
-                    # Stop if we've reached the hotel check-in
-                    if intermediate["event_id"] == next_event["event_id"]:
-                        break
-                        
-                    # Check if there's a transport arrival at the hotel city
-                    if (intermediate["type"] in ["flight_arrival", "railway_arrival"] 
-                            and intermediate["city"] == hotel_city
-                            and intermediate["time"] < hotel_check_in_time):
-                        has_connection = True
-                        break
-                
-                # If no connection found, report fraud
-                if not has_connection:
-                    flight_event = current["event"]
-                    hotel_event = next_event["event"]
-                    
-                    # Calculate time difference between flight arrival and hotel check-in
-                    time_diff_hours = (hotel_check_in_time - flight_arrival_time).total_seconds() / 3600
-                    
-                    fraud_instances.append({
-                        "primary_event_id": hotel_event.event_id,
-                        "secondary_event_id": flight_event.event_id,
-                        "user_id": user_id,
-                        "user_name": hotel_event.user_name,
-                        "department": hotel_event.department,
-                        "flight_arrival_city": flight_arrival_city,
-                        "hotel_city": hotel_city,
-                        "flight_arrival_time": flight_arrival_time.strftime("%Y-%m-%d %H:%M"),
-                        "hotel_check_in_time": hotel_check_in_time.strftime("%Y-%m-%d %H:%M"),
-                        "time_difference_hours": round(time_diff_hours, 2)
-                    })
+                fraud_instances.append({
+                    "primary_event_id": hotel_event.event_id,
+                    "secondary_event_id": flight_event.event_id,
+                    "user_id": user_id,
+                    "user_name": hotel_event.user_name,
+                    "department": hotel_event.department,
+                    "flight_arrival_city": previous.city,
+                    "hotel_city": current.city,
+                    "flight_arrival_time": flight_arrival_time,
+                    "hotel_check_in_time": hotel_check_in_time,
+                    "time_difference_hours": round(time_diff_hours, 2)
+                })
+            
+            previous = current
     
     return fraud_instances if fraud_instances else False
 
@@ -182,16 +196,18 @@ def format_flight_hotel_city_mismatch_alert(rule, events, extra_data, context):
     department = extra_data.get("department")
     flight_city = extra_data.get("flight_arrival_city")
     hotel_city = extra_data.get("hotel_city")
-    flight_time = extra_data.get("flight_arrival_time")
-    hotel_time = extra_data.get("hotel_check_in_time")
+    flight_time = _format_time(extra_data.get("flight_arrival_time"))
+    hotel_time = _format_time(extra_data.get("hotel_check_in_time"))
     time_diff = extra_data.get("time_difference_hours")
     
     # Find the primary and secondary events
     primary_event_id = extra_data.get("primary_event_id")
     secondary_event_id = extra_data.get("secondary_event_id")
     
-    primary_event = next((e for e in events if e.event_id == primary_event_id), None)
-    secondary_event = next((e for e in events if e.event_id == secondary_event_id), None)
+    # One pass over events serves both lookups
+    event_index = _index_events(events)
+    primary_event = event_index.get(primary_event_id)
+    secondary_event = event_index.get(secondary_event_id)
     
     title = f"City Mismatch: Flight to {flight_city}, Hotel in {hotel_city}"
     
@@ -1,8 +1,100 @@
+import bisect
 from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
+from collections import defaultdict
+from operator import attrgetter
 from expensecbr.base import TrajectoryEvent, HotelEvent, FlightEvent
 from expensecbr.fde import create_time_window_rule
 
+_EPOCH = datetime(1970, 1, 1)
+
+# Display format for times in alerts; detection results keep raw datetimes
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+# Minimum reasonable time includes deplaning, baggage claim, and transit to hotel
+MIN_REASONABLE_GAP_HOURS = 1.0  # 1 hour as minimum reasonable time
+# Maximum reasonable time before checking in (without another event explaining the gap)
+MAX_REASONABLE_GAP_HOURS = 8.0  # 8 hours as maximum reasonable gap
+EARLY_ARRIVAL_MAX_GAP_HOURS = 12.0  # Allow longer gap for early arrivals
+
+# Bucket name for each event class this rule uses; other classes map to ""
+_EVENT_BUCKETS = ((HotelEvent, "hotel"), (FlightEvent, "flight"))
+_bucket_by_type = {}
+
+
+def _resolve_bucket(event_type):
+    """Resolve and cache whether an event class is a hotel or a flight, honouring subclasses"""
+    bucket = next((name for cls, name in _EVENT_BUCKETS if issubclass(event_type, cls)), "")
+    _bucket_by_type[event_type] = bucket
+    return bucket
+
+
+def _to_seconds(t):
+    """Epoch seconds, so arrival to check-in gaps are a float subtraction"""
+    if t.tzinfo is not None:
+        return t.timestamp()
+    return (t - _EPOCH).total_seconds()
+
+
+def _format_time(value):
+    """Arrival and check-in times as shown in the alert; other values are shown as given"""
+    return value.strftime(TIME_FORMAT) if isinstance(value, datetime) else value
+
+
+def _has_intermediate_event(starts, start_event_ids, lower, upper, excluded_ids):
+    """Check whether any event starts strictly between lower and upper, ignoring excluded_ids"""
+    lo = bisect.bisect_right(starts, lower)
+    hi = bisect.bisect_left(starts, upper, lo)
+    for idx in range(lo, hi):
+        if start_event_ids[idx] not in excluded_ids:
+            return True
+    return False
+
+
+def _classify_time_gap(time_gap_hours, arrival_hour, check_in_hour):
+    """Classify an arrival-to-check-in gap as (conflict_type, reasonable_gap), or None if normal"""
+    # Case 1: Check-in occurs too soon after arrival (physically impossible)
+    if 0 <= time_gap_hours < MIN_REASONABLE_GAP_HOURS:
+        return "too_soon", MIN_REASONABLE_GAP_HOURS
+    
+    # Case 2: Check-in occurs very late after arrival (suspiciously long gap)
+    max_reasonable_gap_hours = MAX_REASONABLE_GAP_HOURS
+    
+    # For overnight flights, allow longer gap if arrival is early morning and check-in is afternoon
+    if arrival_hour < 7 and check_in_hour >= 14:
+        max_reasonable_gap_hours = EARLY_ARRIVAL_MAX_GAP_HOURS
+    
+    if time_gap_hours > max_reasonable_gap_hours:
+        return "too_late", max_reasonable_gap_hours
+    
+    return None
+
+
+def _build_fraud_instance(user_id, flight, hotel, city, arrival_time, check_in_time,
+                          time_gap_hours, conflict_type, reasonable_gap_hours):
+    """Build the detection result for a flagged flight/hotel pair"""
+    # too_soon reports the minimum reasonable gap, too_late the maximum
+    gap_field = "min_reasonable_gap" if conflict_type == "too_soon" else "max_reasonable_gap"
+    # Optional attributes keep their getattr defaults: not every event class defines them
+    return {
+        "primary_event_id": hotel.event_id,
+        "flight_event_id": flight.event_id,
+        "user_id": user_id,
+        "user_name": hotel.user_name,
+        "department": hotel.department,
+        "conflict_type": conflict_type,
+        "city": city,
+        "arrival_time": arrival_time,
+        "check_in_time": check_in_time,
+        "time_gap_hours": round(time_gap_hours, 2),
+        gap_field: reasonable_gap_hours,
+        "flight_number": getattr(flight, "flight_number", "Unknown"),
+        "hotel_name": getattr(hotel, "specific_location", "Unknown"),
+        "hotel_amount": getattr(hotel, "amount", None),
+        "flight_amount": getattr(flight, "amount", None)
+    }
+
+
 def detect_flight_hotel_time_gap(rule, events, context):
     """
     Detect logical time conflicts between flight arrivals and hotel check-ins.
@@ -17,134 +109,96 @@ def detect_flight_hotel_time_gap(rule, events, context):
     if not events:
         return False
     
-    # Group events by user_id
-    events_by_user = {}
+    # Group events by user_id and split them by type in a single pass
+    events_by_user = defaultdict(lambda: {"all": [], "hotel": [], "flight": []})
     for event in events:
-        if event.user_id not in events_by_user:
-            events_by_user[event.user_id] = []
-        events_by_user[event.user_id].append(event)
+        user_buckets = events_by_user[event.user_id]
+        user_buckets["all"].append(event)
+        event_type = type(event)
+        bucket = _bucket_by_type.get(event_type)
+        if bucket is None:
+            bucket = _resolve_bucket(event_type)
+        if bucket:
+            user_buckets[bucket].append(event)
     
     fraud_instances = []
     
-    for user_id, user_events in events_by_user.items():
-        # Filter for hotel and flight events
-        hotel_events = [e for e in user_events if isinstance(e, HotelEvent)]
-        flight_events = [e for e in user_events if isinstance(e, FlightEvent)]
+    for user_id, user_buckets in events_by_user.items():
+        user_events = user_buckets["all"]
+        hotel_events = user_buckets["hotel"]
+        flight_events = user_buckets["flight"]
         
         # Skip if user doesn't have both hotel and flight events
         if not hotel_events or not flight_events:
             continue
         
         # Sort events by time
-        hotel_events.sort(key=lambda e: e.time_window.earliest_start)
-        flight_events.sort(key=lambda e: e.time_window.earliest_start)
+        sort_key = attrgetter("time_window.earliest_start")
+        user_events.sort(key=sort_key)
+        hotel_events.sort(key=sort_key)
+        flight_events.sort(key=sort_key)
         
-        # Check each flight arrival against subsequent hotel check-ins
+        # Sorted start times of all user events, used to look for intermediate events
+        starts = [sort_key(e) for e in user_events]
+        start_event_ids = [e.event_id for e in user_events]
+        
+        # Resolve flight arrival details once (prefer exact time, fall back to latest end time)
+        flight_arrivals = []
         for flight in flight_events:
-            # Get flight arrival details
+            # Resolved once per flight; the attribute is optional, so the default stays
             arrival_location = getattr(flight, "arrival_location", None)
             arrival_city = arrival_location.city if arrival_location else None
-            
             if not arrival_city:
                 continue
-                
-            # Get flight arrival time (prefer exact time, fall back to latest end time)
             arrival_time = flight.time_window.exact_end_time or flight.time_window.latest_end
-            arrival_date = arrival_time.date()
-            
-            # Find hotel check-ins on the same day or the day after the flight arrival
-            relevant_hotels = []
-            for hotel in hotel_events:
-                check_in_time = hotel.time_window.exact_start_time or hotel.time_window.earliest_start
-                check_in_date = check_in_time.date()
-                
-                # Consider check-ins on the same day or next day
-                date_diff = (check_in_date - arrival_date).days
-                if 0 <= date_diff <= 1:
-                    relevant_hotels.append(hotel)
+            flight_arrivals.append(
+                (flight, arrival_time, _to_seconds(arrival_time), arrival_time.date(), arrival_city)
+            )
+        
+        # Index hotel check-ins by (check-in date, city)
+        hotels_by_date_city = defaultdict(list)
+        for hotel in hotel_events:
+            hotel_location = hotel.location
+            hotel_city = hotel_location.city if hotel_location else None
+            if not hotel_city:
+                continue
+            check_in_time = hotel.time_window.exact_start_time or hotel.time_window.earliest_start
+            hotels_by_date_city[(check_in_time.date(), hotel_city)].append(
+                (hotel, check_in_time, _to_seconds(check_in_time))
+            )
+        
+        # Check each flight arrival against subsequent hotel check-ins
+        for flight, arrival_time, arrival_ts, arrival_date, arrival_city in flight_arrivals:
+            # Consider check-ins in the arrival city on the same day or next day;
+            # hotels in other cities are covered by another rule
+            next_date = arrival_date + timedelta(days=1)
+            candidates = (hotels_by_date_city.get((arrival_date, arrival_city), [])
+                          + hotels_by_date_city.get((next_date, arrival_city), []))
             
-            for hotel in relevant_hotels:
-                # Get hotel details
-                hotel_location = hotel.location
-                hotel_city = hotel_location.city if hotel_location else None
+            for hotel, check_in_time, check_in_ts in candidates:
+                # Calculate time gap between flight arrival and hotel check-in
+                time_gap_hours = (check_in_ts - arrival_ts) / 3600
                 
-                if not hotel_city:
+                # Most pairs fall in the normal range (or check in before arrival); reject them
+                # before resolving hours of day
+                if time_gap_hours < 0 or MIN_REASONABLE_GAP_HOURS <= time_gap_hours <= MAX_REASONABLE_GAP_HOURS:
                     continue
-                    
-                # Get hotel check-in time
-                check_in_time = hotel.time_window.exact_start_time or hotel.time_window.earliest_start
                 
-                # Skip if cities don't match - covered by another rule
-                if hotel_city != arrival_city:
+                classification = _classify_time_gap(time_gap_hours, arrival_time.hour, check_in_time.hour)
+                if classification is None:
                     continue
+                conflict_type, reasonable_gap_hours = classification
                 
-                # Calculate time gap between flight arrival and hotel check-in
-                time_gap_hours = (check_in_time - arrival_time).total_seconds() / 3600
-                
-                # Case 1: Check-in occurs too soon after arrival (physically impossible)
-                # Minimum reasonable time includes deplaning, baggage claim, and transit to hotel
-                min_reasonable_gap_hours = 1.0  # 1 hour as minimum reasonable time
-                
-                if 0 <= time_gap_hours < min_reasonable_gap_hours:
-                    fraud_instances.append({
-                        "primary_event_id": hotel.event_id,
-                        "flight_event_id": flight.event_id,
-                        "user_id": user_id,
-                        "user_name": hotel.user_name,
-                        "department": hotel.department,
-                        "conflict_type": "too_soon",
-                        "city": hotel_city,
-                        "arrival_time": arrival_time.strftime("%Y-%m-%d %H:%M"),
-                        "check_in_time": check_in_time.strftime("%Y-%m-%d %H:%M"),
-                        "time_gap_hours": round(time_gap_hours, 2),
-                        "min_reasonable_gap": min_reasonable_gap_hours,
-                        "flight_number": getattr(flight, "flight_number", "Unknown"),
-                        "hotel_name": getattr(hotel, "specific_location", "Unknown"),
-                        "hotel_amount": getattr(hotel, "amount", None),
-                        "flight_amount": getattr(flight, "amount", None)
-                    })
-                
-                # Case 2: Check-in occurs very late after arrival (suspiciously long gap)
-                # Maximum reasonable time before checking in (without another event explaining the gap)
-                max_reasonable_gap_hours = 8.0  # 8 hours as maximum reasonable gap
-                
-                # For overnight flights, allow longer gap if arrival is early morning and check-in is afternoon
-                is_early_morning_arrival = arrival_time.hour < 7
-                is_afternoon_checkin = check_in_time.hour >= 14
-                
-                # Adjust max gap for early morning arrivals
-                if is_early_morning_arrival and is_afternoon_checkin:
-                    max_reasonable_gap_hours = 12.0  # Allow longer gap for early arrivals
+                # Long gaps are only suspicious if no other event explains them
+                if conflict_type == "too_late" and _has_intermediate_event(
+                        starts, start_event_ids, arrival_time, check_in_time,
+                        (flight.event_id, hotel.event_id)):
+                    continue
                 
-                # Check if there's a suspiciously long gap
-                if time_gap_hours > max_reasonable_gap_hours:
-                    # Check if there are any other events in between that might explain the gap
-                    has_intermediate_events = False
-                    for event in user_events:
-                        if (event != flight and event != hotel and 
-                                arrival_time < event.time_window.earliest_start < check_in_time):
-                            has_intermediate_events = True
-                            break
-                    
-                    # Only flag if there are no intermediate events explaining the gap
-                    if not has_intermediate_events:
-                        fraud_instances.append({
-                            "primary_event_id": hotel.event_id,
-                            "flight_event_id": flight.event_id,
-                            "user_id": user_id,
-                            "user_name": hotel.user_name,
-                            "department": hotel.department,
-                            "conflict_type": "too_late",
-                            "city": hotel_city,
-                            "arrival_time": arrival_time.strftime("%Y-%m-%d %H:%M"),
-                            "check_in_time": check_in_time.strftime("%Y-%m-%d %H:%M"),
-                            "time_gap_hours": round(time_gap_hours, 2),
-                            "max_reasonable_gap": max_reasonable_gap_hours,
-                            "flight_number": getattr(flight, "flight_number", "Unknown"),
-                            "hotel_name": getattr(hotel, "specific_location", "Unknown"),
-                            "hotel_amount": getattr(hotel, "amount", None),
-                            "flight_amount": getattr(flight, "amount", None)
-                        })
+                fraud_instances.append(_build_fraud_instance(
+                    user_id, flight, hotel, arrival_city, arrival_time, check_in_time,
+                    time_gap_hours, conflict_type, reasonable_gap_hours
+                ))
     
     return fraud_instances if fraud_instances else False
 
@@ -157,8 +211,8 @@ def format_flight_hotel_time_gap_alert(rule, events, extra_data, context):
     department = extra_data.get("department")
     conflict_type = extra_data.get("conflict_type")
     city = extra_data.get("city")
-    arrival_time = extra_data.get("arrival_time")
-    check_in_time = extra_data.get("check_in_time")
+    arrival_time = _format_time(extra_data.get("arrival_time"))
+    check_in_time = _format_time(extra_data.get("check_in_time"))
     time_gap_hours = extra_data.get("time_gap_hours")
     flight_number = extra_data.get("flight_number")
     hotel_name = extra_data.get("hotel_name")
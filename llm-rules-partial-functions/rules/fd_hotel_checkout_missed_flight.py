@@ -1,8 +1,78 @@
+import sys
 from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
+from collections import defaultdict
 from expensecbr.base import TrajectoryEvent, HotelEvent, FlightEvent
 from expensecbr.fde import create_time_window_rule
 
+_EPOCH = datetime(1970, 1, 1)
+
+# Display format for times in alerts; detection results keep raw datetimes
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+# Time needed between hotel checkout and flight departure for airport travel and check-in
+CHECKOUT_BUFFER_HOURS = 2
+_CHECKOUT_BUFFER_SECONDS = CHECKOUT_BUFFER_HOURS * 3600
+
+
+def _format_time(value):
+    """Checkout and flight times as shown in the alert; other values are shown as given"""
+    return value.strftime(TIME_FORMAT) if isinstance(value, datetime) else value
+
+
+def _city_of(location):
+    """City of a hotel or departure location, interned, or None when it is unknown"""
+    city = location.city if location else None
+    # Interned so the (date, city) bucket lookups between hotels and flights compare
+    # equal names by identity; non-string cities are used as they are
+    if isinstance(city, str) and city:
+        return sys.intern(city)
+    return city or None
+
+
+def _to_seconds(t):
+    """Epoch seconds for comparing checkouts with departures"""
+    if t.tzinfo is not None:
+        return t.timestamp()
+    return (t - _EPOCH).total_seconds()
+
+
+def _build_user_rows(events):
+    """
+    Extract per-user hotel checkouts and flight departures in a single pass over events.
+    
+    Hotel rows are (hotel, city, checkout_time, checkout_s). Flights are bucketed by
+    (departure date, departure city) as (flight, departure_time, departure_s), so each
+    date is computed once per flight rather than once per hotel. The *_s fields are epoch
+    seconds used for comparisons; datetimes are kept for reporting. Users are registered
+    in the order they first appear in events, and rows keep event order.
+    """
+    rows_by_user = defaultdict(lambda: ([], defaultdict(list)))
+    for event in events:
+        hotel_rows, flights_by_day_city = rows_by_user[event.user_id]
+        if isinstance(event, HotelEvent):
+            hotel_city = _city_of(event.location)
+            if not hotel_city:
+                continue
+            
+            # Get hotel checkout time (prefer exact time, fall back to latest end time)
+            checkout_time = event.time_window.exact_end_time or event.time_window.latest_end
+            hotel_rows.append((event, hotel_city, checkout_time, _to_seconds(checkout_time)))
+        
+        elif isinstance(event, FlightEvent):
+            departure_city = _city_of(getattr(event, "departure_location", None))
+            if not departure_city:
+                continue
+            
+            # Get flight departure time (prefer exact time, fall back to earliest start)
+            departure_time = event.time_window.exact_start_time or event.time_window.earliest_start
+            flights_by_day_city[(departure_time.date(), departure_city)].append(
+                (event, departure_time, _to_seconds(departure_time))
+            )
+    
+    return dict(rows_by_user)
+
+
 def detect_hotel_checkout_missed_flight(rule, events, context):
     """
     Detect when a user checks out of a hotel after their scheduled flight departure time.
@@ -14,81 +84,46 @@ def detect_hotel_checkout_missed_flight(rule, events, context):
     if not events:
         return False
     
-    # Group events by user_id
-    events_by_user = {}
-    for event in events:
-        if event.user_id not in events_by_user:
-            events_by_user[event.user_id] = []
-        events_by_user[event.user_id].append(event)
+    # Per-user hotel checkouts and flight departures
+    rows_by_user = _build_user_rows(events)
     
     fraud_instances = []
     
-    for user_id, user_events in events_by_user.items():
-        # Filter for hotel and flight events
-        hotel_events = [e for e in user_events if isinstance(e, HotelEvent)]
-        flight_events = [e for e in user_events if isinstance(e, FlightEvent)]
-        
-        # Skip if user doesn't have both hotel and flight events
-        if not hotel_events or not flight_events:
+    for user_id, (hotel_rows, flights_by_day_city) in rows_by_user.items():
+        # Skip if user doesn't have both usable hotel and flight events
+        if not hotel_rows or not flights_by_day_city:
             continue
         
         # Process each hotel checkout and check for conflicts with flight departures
-        for hotel in hotel_events:
-            # Get hotel location and checkout time
-            hotel_city = hotel.location.city if hotel.location else None
-            if not hotel_city:
-                continue
-                
-            # Get hotel checkout time (prefer exact time, fall back to latest end time)
-            checkout_time = hotel.time_window.exact_end_time or hotel.time_window.latest_end
-            checkout_date = checkout_time.date()
-            
-            # Check for flights departing on the same day as the hotel checkout
-            same_day_flights = [
-                f for f in flight_events 
-                if (f.time_window.exact_start_time or f.time_window.earliest_start).date() == checkout_date
-            ]
+        for hotel, hotel_city, checkout_time, checkout_s in hotel_rows:
+            # Only flights departing from the hotel's city on the checkout day can be missed
+            same_day_flights = flights_by_day_city.get((checkout_time.date(), hotel_city), ())
             
-            for flight in same_day_flights:
-                # Get flight departure details
-                departure_location = getattr(flight, "departure_location", None)
-                departure_city = departure_location.city if departure_location else None
+            for flight, departure_time, departure_s in same_day_flights:
+                # Latest checkout that still leaves the buffer before the flight
+                latest_checkout_s = departure_s - _CHECKOUT_BUFFER_SECONDS
                 
-                if not departure_city:
+                # Hotel checkout leaves enough time for this flight
+                if checkout_s <= latest_checkout_s:
                     continue
                 
-                # Get flight departure time (prefer exact time, fall back to earliest start)
-                departure_time = flight.time_window.exact_start_time or flight.time_window.earliest_start
-                
-                # Only consider flights departing from the same city as the hotel
-                if departure_city != hotel_city:
-                    continue
-                
-                # Calculate how much buffer time is needed before flight (minimum 2 hours)
-                buffer_hours = 2
-                latest_checkout_time = departure_time - timedelta(hours=buffer_hours)
-                
-                # Check if hotel checkout is after the recommended airport arrival time
-                if checkout_time > latest_checkout_time:
-                    # Calculate how late the checkout is compared to when they should leave for airport
-                    time_diff_minutes = round((checkout_time - latest_checkout_time).total_seconds() / 60)
-                    
-                    fraud_instances.append({
-                        "primary_event_id": hotel.event_id,
-                        "flight_event_id": flight.event_id,
-                        "user_id": user_id,
-                        "user_name": hotel.user_name,
-                        "department": hotel.department,
-                        "hotel_city": hotel_city,
-                        "flight_departure_city": departure_city,
-                        "checkout_time": checkout_time.strftime("%Y-%m-%d %H:%M"),
-                        "flight_time": departure_time.strftime("%Y-%m-%d %H:%M"),
-                        "buffer_hours": buffer_hours,
-                        "minutes_late": time_diff_minutes,
-                        "flight_number": getattr(flight, "flight_number", "Unknown"),
-                        "hotel_amount": getattr(hotel, "amount", None),
-                        "flight_amount": getattr(flight, "amount", None)
-                    })
+                fraud_instances.append({
+                    "primary_event_id": hotel.event_id,
+                    "flight_event_id": flight.event_id,
+                    "user_id": user_id,
+                    "user_name": hotel.user_name,
+                    "department": hotel.department,
+                    "hotel_city": hotel_city,
+                    "flight_departure_city": hotel_city,
+                    "checkout_time": checkout_time,
+                    "flight_time": departure_time,
+                    "buffer_hours": CHECKOUT_BUFFER_HOURS,
+                    # How late the checkout is compared to when they should leave for the airport
+                    "minutes_late": round((checkout_s - latest_checkout_s) / 60),
+                    "flight_number": getattr(flight, "flight_number", "Unknown"),
+                    "hotel_amount": getattr(hotel, "amount", None),
+                    "flight_amount": getattr(flight, "amount", None)
+                })
     
     return fraud_instances if fraud_instances else False
 
@@ -100,8 +135,8 @@ def format_hotel_checkout_missed_flight_alert(rule, events, extra_data, context)
     user_name = extra_data.get("user_name")
     department = extra_data.get("department")
     city = extra_data.get("hotel_city")
-    checkout_time = extra_data.get("checkout_time")
-    flight_time = extra_data.get("flight_time")
+    checkout_time = _format_time(extra_data.get("checkout_time"))
+    flight_time = _format_time(extra_data.get("flight_time"))
     buffer_hours = extra_data.get("buffer_hours")
     minutes_late = extra_data.get("minutes_late")
     flight_number = extra_data.get("flight_number")
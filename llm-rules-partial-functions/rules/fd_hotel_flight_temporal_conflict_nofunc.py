@@ -1,8 +1,154 @@
+import bisect
+import sys
 from typing import Dict, Any, List, Optional
 from datetime import datetime, timedelta
+from collections import defaultdict
 from expensecbr.base import TrajectoryEvent, HotelEvent, FlightEvent
 from expensecbr.fde import create_time_window_rule
 
+_EPOCH = datetime(1970, 1, 1)
+
+# Display format for times in alerts; detection results keep raw datetimes
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+# Transit time allowed between a flight and the hotel stay it overlaps
+TRANSIT_BUFFER_HOURS = 2
+# Minimum travel time between cities, used for check-in/check-out right around a flight
+MIN_TRAVEL_HOURS = 3
+_TRANSIT_BUFFER_SECONDS = TRANSIT_BUFFER_HOURS * 3600
+_MIN_TRAVEL_SECONDS = MIN_TRAVEL_HOURS * 3600
+
+
+def _format_time(value):
+    """Hotel and flight times as shown in the conflict details; other values are shown as given"""
+    return value.strftime(TIME_FORMAT) if isinstance(value, datetime) else value
+
+
+def _positions_in_range(sorted_times, positions, lower, upper):
+    """Positions of the entries whose time lies strictly between lower and upper"""
+    lo = bisect.bisect_right(sorted_times, lower)
+    hi = bisect.bisect_left(sorted_times, upper, lo)
+    return positions[lo:hi]
+
+
+def _city_of(location):
+    """Interned city of a hotel or flight location, or None when it is unknown"""
+    city = location.city if location else None
+    # Interned so the hotel/flight city comparisons in the scenario checks see equal
+    # names by identity; non-string cities are used as they are
+    if isinstance(city, str) and city:
+        return sys.intern(city)
+    return city or None
+
+
+def _to_seconds(t):
+    """Epoch seconds for the scenario checks"""
+    if t.tzinfo is not None:
+        return t.timestamp()
+    return (t - _EPOCH).total_seconds()
+
+
+def _event_times(event):
+    """(start, end) of a hotel stay or flight, preferring exact times over the window bounds"""
+    time_window = event.time_window
+    return (time_window.exact_start_time or time_window.earliest_start,
+            time_window.exact_end_time or time_window.latest_end)
+
+
+def _build_user_rows(events):
+    """
+    Extract per-user hotel and flight rows in a single pass over events.
+    
+    Hotel rows are (hotel, city, check_in, check_out, check_in_s, check_out_s) and flight
+    rows are (flight, departure_city, arrival_city, departure_time, arrival_time,
+    departure_s, arrival_s). The *_s fields are epoch seconds used for comparisons;
+    datetimes are kept for reporting. Locations are resolved once per event here, so
+    the per-hotel scans never touch event attributes. Users are registered in the order
+    they first appear in events, and rows keep event order.
+    """
+    rows_by_user = defaultdict(lambda: ([], []))
+    for event in events:
+        hotel_rows, flight_rows = rows_by_user[event.user_id]
+        if isinstance(event, HotelEvent):
+            hotel_city = _city_of(event.location)
+            if not hotel_city:
+                continue
+            
+            # Use the exact times if available, otherwise use the time window
+            check_in_time, check_out_time = _event_times(event)
+            
+            hotel_rows.append((
+                event, hotel_city, check_in_time, check_out_time,
+                _to_seconds(check_in_time), _to_seconds(check_out_time)
+            ))
+        
+        elif isinstance(event, FlightEvent):
+            departure_city = _city_of(getattr(event, "departure_location", None))
+            arrival_city = _city_of(getattr(event, "arrival_location", None))
+            
+            # Skip if flight location information is incomplete
+            if not departure_city or not arrival_city:
+                continue
+            
+            # Get flight departure and arrival times
+            departure_time, arrival_time = _event_times(event)
+            
+            flight_rows.append((
+                event, departure_city, arrival_city, departure_time, arrival_time,
+                _to_seconds(departure_time), _to_seconds(arrival_time)
+            ))
+    
+    return dict(rows_by_user)
+
+
+def _conflict_scenarios(hotel_city, check_in_s, check_out_s,
+                        departure_city, arrival_city, departure_s, arrival_s):
+    """
+    Conflict types raised by one hotel/flight pair, in scenario order.
+    
+    Works only on city strings and epoch seconds so the per-pair checks stay a tight,
+    allocation-free loop body; the caller builds the fraud instances from the result.
+    
+    Scenarios 1 and 4 place the departure inside and after the stay respectively, so at
+    most one of them applies to a pair; the same holds for the arrival in scenarios 2 and 3.
+    The pair therefore never needs a second alert for the same flight leg.
+    """
+    conflicts = []
+    departs_elsewhere = departure_city != hotel_city
+    arrives_elsewhere = arrival_city != hotel_city
+    if not departs_elsewhere and not arrives_elsewhere:
+        return conflicts
+    
+    departs_during_stay = check_in_s < departure_s < check_out_s
+    arrives_during_stay = check_in_s < arrival_s < check_out_s
+    
+    # Scenario 1: Flight departs from a different city during the hotel stay
+    # (allowing a transit buffer before departure)
+    if (departs_elsewhere and departs_during_stay
+            and departure_s - _TRANSIT_BUFFER_SECONDS > check_in_s):
+        conflicts.append("departure_during_stay")
+    
+    # Scenario 2: Flight arrives at a different city during the hotel stay
+    # (allowing a transit buffer after arrival)
+    if (arrives_elsewhere and arrives_during_stay
+            and arrival_s + _TRANSIT_BUFFER_SECONDS < check_out_s):
+        conflicts.append("arrival_during_stay")
+    
+    # Scenario 3: Hotel check-in in a different city less than the minimum travel
+    # time after the flight arrives; a flight arriving during the stay cannot qualify
+    if (arrives_elsewhere and not arrives_during_stay
+            and 0 < check_in_s - arrival_s < _MIN_TRAVEL_SECONDS):
+        conflicts.append("impossible_checkin_after_flight")
+    
+    # Scenario 4: Flight departs from a different city less than the minimum travel
+    # time after hotel check-out; a flight departing during the stay cannot qualify
+    if (departs_elsewhere and not departs_during_stay
+            and 0 < departure_s - check_out_s < _MIN_TRAVEL_SECONDS):
+        conflicts.append("impossible_checkout_before_flight")
+    
+    return conflicts
+
+
 def detect_hotel_flight_temporal_conflict(rule, events, context):
     """
     Detect temporal conflicts between hotel stays and flight itineraries.
@@ -16,150 +162,108 @@ def detect_hotel_flight_temporal_conflict(rule, events, context):
     if not events:
         return False
     
-    # Group events by user_id
-    events_by_user = {}
-    for event in events:
-        if event.user_id not in events_by_user:
-            events_by_user[event.user_id] = []
-        events_by_user[event.user_id].append(event)
+    # Per-user hotel and flight rows
+    rows_by_user = _build_user_rows(events)
     
     fraud_instances = []
+    # (hotel, flight, conflict type) combinations already reported, so repeated
+    # events in the window do not produce duplicate alerts
+    seen = set()
     
-    for user_id, user_events in events_by_user.items():
-        # Filter for hotel and flight events
-        hotel_events = [e for e in user_events if isinstance(e, HotelEvent)]
-        flight_events = [e for e in user_events if isinstance(e, FlightEvent)]
-        
-        # Skip if user doesn't have both hotel and flight events
-        if not hotel_events or not flight_events:
+    for user_id, (hotel_info, flight_info) in rows_by_user.items():
+        # Skip if user doesn't have both usable hotel and flight events
+        if not hotel_info or not flight_info:
             continue
         
-        # Check each hotel event against each flight event
-        for hotel in hotel_events:
-            hotel_city = hotel.location.city if hotel.location else None
-            if not hotel_city:
+        # Flight positions ordered by departure and by arrival, for range lookups per hotel
+        by_departure = sorted(range(len(flight_info)), key=lambda i: flight_info[i][5])
+        departure_seconds = [flight_info[i][5] for i in by_departure]
+        by_arrival = sorted(range(len(flight_info)), key=lambda i: flight_info[i][6])
+        arrival_seconds = [flight_info[i][6] for i in by_arrival]
+        
+        # Every scenario needs a flight city that differs from the hotel city
+        flight_cities = {row[1] for row in flight_info} | {row[2] for row in flight_info}
+        single_flight_city = next(iter(flight_cities)) if len(flight_cities) == 1 else None
+        
+        # Check each hotel event against the flights that can conflict with it
+        for hotel, hotel_city, check_in_time, check_out_time, check_in_s, check_out_s in hotel_info:
+            # All flights start and end in this hotel's city, so nothing can conflict
+            if hotel_city == single_flight_city:
                 continue
-                
-            # Get hotel check-in and check-out times
-            # Use the exact times if available, otherwise use the time window
-            check_in_time = hotel.time_window.exact_start_time or hotel.time_window.earliest_start
-            check_out_time = hotel.time_window.exact_end_time or hotel.time_window.latest_end
             
-            for flight in flight_events:
-                # Get flight departure and arrival information
-                departure_city = getattr(flight, "departure_location", None)
-                departure_city = departure_city.city if departure_city else None
-                
-                arrival_city = getattr(flight, "arrival_location", None)
-                arrival_city = arrival_city.city if arrival_city else None
-                
-                # Skip if flight location information is incomplete
-                if not departure_city or not arrival_city:
-                    continue
-                
-                # Get flight departure and arrival times
-                departure_time = flight.time_window.exact_start_time or flight.time_window.earliest_start
-                arrival_time = flight.time_window.exact_end_time or flight.time_window.latest_end
+            # Bind hotel fields once; they are reused for every candidate flight
+            hotel_event_id = hotel.event_id
+            hotel_user_name = hotel.user_name
+            hotel_department = hotel.department
+            
+            # Only flights departing or arriving during the stay (scenarios 1 and 2), arriving
+            # shortly before check-in (scenario 3) or departing shortly after check-out
+            # (scenario 4) can conflict
+            candidates = set()
+            candidates.update(_positions_in_range(departure_seconds, by_departure, check_in_s, check_out_s))
+            candidates.update(_positions_in_range(arrival_seconds, by_arrival, check_in_s, check_out_s))
+            candidates.update(_positions_in_range(arrival_seconds, by_arrival, check_in_s - _MIN_TRAVEL_SECONDS, check_in_s))
+            candidates.update(_positions_in_range(departure_seconds, by_departure, check_out_s, check_out_s + _MIN_TRAVEL_SECONDS))
+            
+            # Visit candidates in their original order so results are emitted as before
+            for position in sorted(candidates):
+                (flight, departure_city, arrival_city, departure_time, arrival_time,
+                 departure_s, arrival_s) = flight_info[position]
                 
-                # Scenario 1: Flight departs from a different city during the hotel stay
-                # This is a conflict if the user is checked into a hotel in one city but departing from another
-                if departure_city != hotel_city and departure_time > check_in_time and departure_time < check_out_time:
-                    # Calculate buffer for transit time (2 hours before departure)
-                    transit_buffer_time = departure_time - timedelta(hours=2)
+                for conflict_type in _conflict_scenarios(
+                    hotel_city, check_in_s, check_out_s,
+                    departure_city, arrival_city, departure_s, arrival_s
+                ):
+                    key = (hotel_event_id, flight.event_id, conflict_type)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    
+                    instance = {
+                        "primary_event_id": hotel_event_id,
+                        "user_id": user_id,
+                        "user_name": hotel_user_name,
+                        "department": hotel_department,
+                        "conflict_type": conflict_type,
+                        "hotel_event_id": hotel_event_id,
+                        "flight_event_id": flight.event_id,
+                        "hotel_city": hotel_city,
+                    }
                     
-                    # Check if there's still a conflict after accounting for the buffer
-                    if transit_buffer_time > check_in_time:
-                        fraud_instances.append({
-                            "primary_event_id": hotel.event_id,
-                            "user_id": user_id,
-                            "user_name": hotel.user_name,
-                            "department": hotel.department,
-                            "conflict_type": "departure_during_stay",
-                            "hotel_event_id": hotel.event_id,
-                            "flight_event_id": flight.event_id,
-                            "hotel_city": hotel_city,
+                    if conflict_type == "departure_during_stay":
+                        instance.update({
                             "flight_city": departure_city,
-                            "hotel_check_in": check_in_time.strftime("%Y-%m-%d %H:%M"),
-                            "hotel_check_out": check_out_time.strftime("%Y-%m-%d %H:%M"),
-                            "flight_time": departure_time.strftime("%Y-%m-%d %H:%M"),
+                            "hotel_check_in": check_in_time,
+                            "hotel_check_out": check_out_time,
+                            "flight_time": departure_time,
                             "flight_direction": "departure",
                         })
-                
-                # Scenario 2: Flight arrives at a different city during the hotel stay
-                # This is a conflict if the user is checked into a hotel in one city but arriving at another
-                if arrival_city != hotel_city and arrival_time > check_in_time and arrival_time < check_out_time:
-                    # Calculate buffer for transit time (2 hours after arrival)
-                    transit_buffer_time = arrival_time + timedelta(hours=2)
-                    
-                    # Check if there's still a conflict after accounting for the buffer
-                    if transit_buffer_time < check_out_time:
-                        fraud_instances.append({
-                            "primary_event_id": hotel.event_id,
-                            "user_id": user_id,
-                            "user_name": hotel.user_name,
-                            "department": hotel.department,
-                            "conflict_type": "arrival_during_stay",
-                            "hotel_event_id": hotel.event_id,
-                            "flight_event_id": flight.event_id,
-                            "hotel_city": hotel_city,
+                    elif conflict_type == "arrival_during_stay":
+                        instance.update({
                             "flight_city": arrival_city,
-                            "hotel_check_in": check_in_time.strftime("%Y-%m-%d %H:%M"),
-                            "hotel_check_out": check_out_time.strftime("%Y-%m-%d %H:%M"),
-                            "flight_time": arrival_time.strftime("%Y-%m-%d %H:%M"),
+                            "hotel_check_in": check_in_time,
+                            "hotel_check_out": check_out_time,
+                            "flight_time": arrival_time,
                             "flight_direction": "arrival",
                         })
-                
-                # Scenario 3: Hotel check-in is immediately after a flight arrival in a different city
-                # This is a conflict if there's not enough time to travel between cities
-                if arrival_city != hotel_city:
-                    # Estimate minimum travel time between cities (at least 3 hours as a baseline)
-                    min_travel_hours = 3
-                    
-                    # Calculate the time between flight arrival and hotel check-in
-                    time_difference = (check_in_time - arrival_time).total_seconds() / 3600  # in hours
-                    
-                    if 0 < time_difference < min_travel_hours:
-                        fraud_instances.append({
-                            "primary_event_id": hotel.event_id,
-                            "user_id": user_id,
-                            "user_name": hotel.user_name,
-                            "department": hotel.department,
-                            "conflict_type": "impossible_checkin_after_flight",
-                            "hotel_event_id": hotel.event_id,
-                            "flight_event_id": flight.event_id,
-                            "hotel_city": hotel_city,
+                    elif conflict_type == "impossible_checkin_after_flight":
+                        instance.update({
                             "flight_city": arrival_city,
-                            "hotel_check_in": check_in_time.strftime("%Y-%m-%d %H:%M"),
-                            "flight_arrival": arrival_time.strftime("%Y-%m-%d %H:%M"),
-                            "time_difference_hours": round(time_difference, 2),
-                            "min_travel_hours": min_travel_hours,
+                            "hotel_check_in": check_in_time,
+                            "flight_arrival": arrival_time,
+                            "time_difference_hours": round((check_in_s - arrival_s) / 3600, 2),
+                            "min_travel_hours": MIN_TRAVEL_HOURS,
                         })
-                
-                # Scenario 4: Flight departure is immediately after hotel check-out in a different city
-                # This is a conflict if there's not enough time to travel between cities
-                if departure_city != hotel_city:
-                    # Estimate minimum travel time between cities (at least 3 hours as a baseline)
-                    min_travel_hours = 3
-                    
-                    # Calculate the time between hotel check-out and flight departure
-                    time_difference = (departure_time - check_out_time).total_seconds() / 3600  # in hours
-                    
-                    if 0 < time_difference < min_travel_hours:
-                        fraud_instances.append({
-                            "primary_event_id": hotel.event_id,
-                            "user_id": user_id,
-                            "user_name": hotel.user_name,
-                            "department": hotel.department,
-                            "conflict_type": "impossible_checkout_before_flight",
-                            "hotel_event_id": hotel.event_id,
-                            "flight_event_id": flight.event_id,
-                            "hotel_city": hotel_city,
+                    else:
+                        instance.update({
                             "flight_city": departure_city,
-                            "hotel_check_out": check_out_time.strftime("%Y-%m-%d %H:%M"),
-                            "flight_departure": departure_time.strftime("%Y-%m-%d %H:%M"),
-                            "time_difference_hours": round(time_difference, 2),
-                            "min_travel_hours": min_travel_hours,
+                            "hotel_check_out": check_out_time,
+                            "flight_departure": departure_time,
+                            "time_difference_hours": round((departure_s - check_out_s) / 3600, 2),
+                            "min_travel_hours": MIN_TRAVEL_HOURS,
                         })
+                    
+                    fraud_instances.append(instance)
     
     return fraud_instances if fraud_instances else False
 
@@ -173,13 +277,9 @@ def format_hotel_flight_conflict_alert(rule, events, extra_data, context):
     conflict_type = extra_data.get("conflict_type")
     hotel_city = extra_data.get("hotel_city")
     
-    # Find the primary event
-    primary_event_id = extra_data.get("primary_event_id")
-    primary_event = next((e for e in events if e.event_id == primary_event_id), None)
-    
     # Format title based on conflict type
     if conflict_type == "departure_during_stay":
-        flight_time = extra_data.get("flight_time")
+        flight_time = _format_time(extra_data.get("flight_time"))
         flight_city = extra_data.get("flight_city")
         title = f"Conflict: Hotel Stay in {hotel_city} During Flight Departure from {flight_city}"
         
@@ -187,7 +287,7 @@ def format_hotel_flight_conflict_alert(rule, events, extra_data, context):
             f"User {user_name} ({user_id}) from {department} has a logical conflict "
             f"between hotel stay and flight departure.\n\n"
             f"The user is checked into a hotel in {hotel_city} from "
-            f"{extra_data.get('hotel_check_in')} to {extra_data.get('hotel_check_out')}, "
+            f"{_format_time(extra_data.get('hotel_check_in'))} to {_format_time(extra_data.get('hotel_check_out'))}, "
             f"but has a flight departing from {flight_city} at {flight_time}.\n\n"
             f"This is physically impossible as the user cannot be in two different "
             f"cities at the same time. The user would need to be at the airport in "
@@ -195,7 +295,7 @@ def format_hotel_flight_conflict_alert(rule, events, extra_data, context):
         )
     
     elif conflict_type == "arrival_during_stay":
-        flight_time = extra_data.get("flight_time")
+        flight_time = _format_time(extra_data.get("flight_time"))
         flight_city = extra_data.get("flight_city")
         title = f"Conflict: Hotel Stay in {hotel_city} During Flight Arrival at {flight_city}"
         
@@ -203,7 +303,7 @@ def format_hotel_flight_conflict_alert(rule, events, extra_data, context):
             f"User {user_name} ({user_id}) from {department} has a logical conflict "
             f"between hotel stay and flight arrival.\n\n"
             f"The user is checked into a hotel in {hotel_city} from "
-            f"{extra_data.get('hotel_check_in')} to {extra_data.get('hotel_check_out')}, "
+            f"{_format_time(extra_data.get('hotel_check_in'))} to {_format_time(extra_data.get('hotel_check_out'))}, "
             f"but has a flight arriving at {flight_city} at {flight_time}.\n\n"
             f"This is physically impossible as the user cannot be in two different "
             f"cities at the same time. The user would be arriving at the airport in "
@@ -219,8 +319,8 @@ def format_hotel_flight_conflict_alert(rule, events, extra_data, context):
         details = (
             f"User {user_name} ({user_id}) from {department} has an impossibly tight "
             f"schedule between flight arrival and hotel check-in.\n\n"
-            f"The user arrived in {flight_city} at {extra_data.get('flight_arrival')} "
-            f"but checked into a hotel in {hotel_city} at {extra_data.get('hotel_check_in')}.\n\n"
+            f"The user arrived in {flight_city} at {_format_time(extra_data.get('flight_arrival'))} "
+            f"but checked into a hotel in {hotel_city} at {_format_time(extra_data.get('hotel_check_in'))}.\n\n"
             f"This allows only {time_diff} hours to travel between the cities, which is less "
             f"than the minimum reasonable travel time of {min_hours} hours. This schedule is "
             f"physically impossible to accomplish."
@@ -235,8 +335,8 @@ def format_hotel_flight_conflict_alert(rule, events, extra_data, context):
         details = (
             f"User {user_name} ({user_id}) from {department} has an impossibly tight "
             f"schedule between hotel check-out and flight departure.\n\n"
-            f"The user checked out from a hotel in {hotel_city} at {extra_data.get('hotel_check_out')} "
-            f"but has a flight departing from {flight_city} at {extra_data.get('flight_departure')}.\n\n"
+            f"The user checked out from a hotel in {hotel_city} at {_format_time(extra_data.get('hotel_check_out'))} "
+            f"but has a flight departing from {flight_city} at {_format_time(extra_data.get('flight_departure'))}.\n\n"
             f"This allows only {time_diff} hours to travel between the cities, which is less "
             f"than the minimum reasonable travel time of {min_hours} hours. This schedule is "
             f"physically impossible to accomplish."
@@ -1,8 +1,56 @@
 from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime, timedelta
+from collections import defaultdict
+from operator import itemgetter
 from expensecbr.base import TrajectoryEvent, HotelEvent, TaxiEvent
 from expensecbr.fde import create_time_window_rule
 
+# Per conflict type: (taxi location key, hotel time key, taxi time key) in the detection result
+_CONFLICT_FIELDS = {
+    "check_in": ("taxi_destination", "check_in_time", "taxi_arrival_time"),
+    "check_out": ("taxi_origin", "check_out_time", "taxi_departure_time"),
+}
+
+
+def _taxi_row(position, taxi, location, taxi_time, taxi_date, is_late_night=False):
+    """
+    Index row for one end of a taxi ride: (position, taxi, specific location, lowercased
+    specific location, time, date used for comparison, late-night flag)
+    """
+    specific_location = getattr(location, "specific_location", "")
+    specific_location_lower = specific_location.lower() if specific_location else ""
+    return position, taxi, specific_location, specific_location_lower, taxi_time, taxi_date, is_late_night
+
+
+def _matches_hotel_name(hotel_location_lower, taxi_location_lower):
+    """Partial match between lowercased hotel name and taxi pick-up/drop-off location"""
+    if not hotel_location_lower or not taxi_location_lower:
+        return False
+    return hotel_location_lower in taxi_location_lower or taxi_location_lower in hotel_location_lower
+
+
+def _candidate_taxis(taxis_by_city, hotel_city, hotel_location_lower):
+    """
+    Taxi rows that can match a hotel, in taxi order.
+    
+    Taxis in the hotel's city always qualify. Taxis elsewhere can only match on the
+    hotel's specific location, so they are only considered when the hotel has one.
+    """
+    same_city_taxis = taxis_by_city.get(hotel_city, ())
+    if not hotel_location_lower:
+        return same_city_taxis
+    
+    candidates = list(same_city_taxis)
+    for city, rows in taxis_by_city.items():
+        if city == hotel_city:
+            continue
+        candidates.extend(row for row in rows if _matches_hotel_name(hotel_location_lower, row[3]))
+    
+    if len(candidates) > len(same_city_taxis):
+        candidates.sort(key=itemgetter(0))
+    return candidates
+
+
 def detect_hotel_taxi_checkin_checkout_conflict(rule, events, context):
     """
     Detect conflicts between taxi arrival/departure times and hotel check-in/check-out dates.
@@ -17,23 +65,63 @@ def detect_hotel_taxi_checkin_checkout_conflict(rule, events, context):
         return False
     
     # Group events by user_id
-    events_by_user = {}
+    events_by_user = defaultdict(list)
     for event in events:
-        if event.user_id not in events_by_user:
-            events_by_user[event.user_id] = []
         events_by_user[event.user_id].append(event)
     
     fraud_instances = []
     
     for user_id, user_events in events_by_user.items():
-        # Filter for hotel and taxi events
-        hotel_events = [e for e in user_events if isinstance(e, HotelEvent)]
-        taxi_events = [e for e in user_events if isinstance(e, TaxiEvent)]
+        # Split out hotel and taxi events in a single pass
+        hotel_events = []
+        taxi_events = []
+        for event in user_events:
+            if isinstance(event, HotelEvent):
+                hotel_events.append(event)
+            elif isinstance(event, TaxiEvent):
+                taxi_events.append(event)
         
         # Skip if user doesn't have both hotel and taxi events
         if not hotel_events or not taxi_events:
             continue
         
+        # Time buffer for late night arrivals (consider up to 2 AM as part of previous day)
+        time_buffer_hours = 2
+        
+        # Index taxis by drop-off city and by pick-up city once per user, skipping taxis
+        # without proper location information. The position in each row keeps matches in
+        # taxi order; locations, times and dates are resolved here once per taxi rather
+        # than once per hotel.
+        arrivals_by_city = defaultdict(list)
+        departures_by_city = defaultdict(list)
+        for position, taxi in enumerate(taxi_events):
+            taxi_to_location = getattr(taxi, "to_location", None)
+            if taxi_to_location and taxi_to_location.city:
+                # Get taxi arrival time and date
+                taxi_arrival_time = taxi.time_window.exact_end_time or taxi.time_window.latest_end
+                
+                # Special handling for late night arrivals
+                if taxi_arrival_time.hour < time_buffer_hours:
+                    # For arrivals between midnight and 2 AM, adjust the date to previous day
+                    adjusted_arrival_date = (taxi_arrival_time - timedelta(days=1)).date()
+                    is_late_night_arrival = True
+                else:
+                    adjusted_arrival_date = taxi_arrival_time.date()
+                    is_late_night_arrival = False
+                
+                arrivals_by_city[taxi_to_location.city].append(_taxi_row(
+                    position, taxi, taxi_to_location, taxi_arrival_time, adjusted_arrival_date, is_late_night_arrival
+                ))
+            
+            taxi_from_location = getattr(taxi, "from_location", None)
+            if taxi_from_location and taxi_from_location.city:
+                # Get taxi departure time and date
+                taxi_departure_time = taxi.time_window.exact_start_time or taxi.time_window.earliest_start
+                
+                departures_by_city[taxi_from_location.city].append(_taxi_row(
+                    position, taxi, taxi_from_location, taxi_departure_time, taxi_departure_time.date()
+                ))
+        
         # For each hotel stay, check for related taxi events
         for hotel in hotel_events:
             hotel_location = hotel.location
@@ -42,7 +130,13 @@ def detect_hotel_taxi_checkin_checkout_conflict(rule, events, context):
             
             if not hotel_city:
                 continue
-                
+            
+            # Bind hotel fields once; they are reused for every candidate taxi
+            hotel_location_lower = hotel_specific_location.lower() if hotel_specific_location else ""
+            hotel_event_id = hotel.event_id
+            hotel_user_name = hotel.user_name
+            hotel_department = hotel.department
+            
             # Get hotel check-in and check-out times
             check_in_time = hotel.time_window.exact_start_time or hotel.time_window.earliest_start
             check_out_time = hotel.time_window.exact_end_time or hotel.time_window.latest_end
@@ -50,130 +144,52 @@ def detect_hotel_taxi_checkin_checkout_conflict(rule, events, context):
             check_in_date = check_in_time.date()
             check_out_date = check_out_time.date()
             
-            # Time buffer for late night arrivals (consider up to 2 AM as part of previous day)
-            time_buffer_hours = 2
-            
-            # 1. Check taxis arriving at the hotel (potential check-in conflicts)
-            for taxi in taxi_events:
-                # Skip taxis without proper location information
-                taxi_to_location = getattr(taxi, "to_location", None)
-                if not taxi_to_location or not taxi_to_location.city:
-                    continue
-                
-                # Get taxi arrival time and date
-                taxi_arrival_time = taxi.time_window.exact_end_time or taxi.time_window.latest_end
-                taxi_arrival_date = taxi_arrival_time.date()
-                
-                # Check if taxi destination matches hotel location
-                is_same_city = taxi_to_location.city == hotel_city
-                
-                # If specific location available, check that too for higher confidence
-                has_matching_specific_location = False
-                if hotel_specific_location and hasattr(taxi_to_location, "specific_location"):
-                    taxi_specific_location = getattr(taxi_to_location, "specific_location", "")
-                    # Check if hotel name appears in taxi destination
-                    if taxi_specific_location and hotel_specific_location:
-                        # Case-insensitive partial match for hotel name in taxi destination
-                        has_matching_specific_location = (
-                            hotel_specific_location.lower() in taxi_specific_location.lower() or
-                            taxi_specific_location.lower() in hotel_specific_location.lower()
-                        )
-                
-                # If specific location matches, it's highly likely to be the same place
-                # If only city matches, still consider it but with lower confidence
-                locations_match = has_matching_specific_location or is_same_city
-                
-                if not locations_match:
-                    continue
-                
-                # Special handling for late night arrivals
-                is_late_night_arrival = False
-                if taxi_arrival_time.hour < time_buffer_hours:
-                    # For arrivals between midnight and 2 AM, adjust the date to previous day
-                    adjusted_arrival_date = (taxi_arrival_time - timedelta(days=1)).date()
-                    is_late_night_arrival = True
-                else:
-                    adjusted_arrival_date = taxi_arrival_date
-                
-                # Check if taxi arrival date conflicts with hotel check-in date
-                date_difference = abs((adjusted_arrival_date - check_in_date).days)
-                
-                # Flag as conflict if dates differ by more than 0 days
-                if date_difference > 0:
-                    fraud_instances.append({
-                        "primary_event_id": hotel.event_id,
-                        "taxi_event_id": taxi.event_id,
-                        "user_id": user_id,
-                        "user_name": hotel.user_name,
-                        "department": hotel.department,
-                        "conflict_type": "check_in",
-                        "hotel_city": hotel_city,
-                        "hotel_location": hotel_specific_location,
-                        "taxi_destination": getattr(taxi_to_location, "specific_location", ""),
-                        "check_in_time": check_in_time.strftime("%Y-%m-%d %H:%M"),
-                        "taxi_arrival_time": taxi_arrival_time.strftime("%Y-%m-%d %H:%M"),
-                        "date_difference": date_difference,
-                        "is_late_night": is_late_night_arrival,
-                        "location_match_confidence": "high" if has_matching_specific_location else "medium",
-                        "hotel_amount": getattr(hotel, "amount", None),
-                        "taxi_amount": getattr(taxi, "amount", None)
-                    })
-            
-            # 2. Check taxis leaving the hotel (potential check-out conflicts)
-            for taxi in taxi_events:
-                # Skip taxis without proper location information
-                taxi_from_location = getattr(taxi, "from_location", None)
-                if not taxi_from_location or not taxi_from_location.city:
-                    continue
-                
-                # Get taxi departure time and date
-                taxi_departure_time = taxi.time_window.exact_start_time or taxi.time_window.earliest_start
-                taxi_departure_date = taxi_departure_time.date()
-                
-                # Check if taxi origin matches hotel location
-                is_same_city = taxi_from_location.city == hotel_city
-                
-                # If specific location available, check that too for higher confidence
-                has_matching_specific_location = False
-                if hotel_specific_location and hasattr(taxi_from_location, "specific_location"):
-                    taxi_specific_location = getattr(taxi_from_location, "specific_location", "")
-                    # Check if hotel name appears in taxi origin
-                    if taxi_specific_location and hotel_specific_location:
-                        # Case-insensitive partial match for hotel name in taxi origin
-                        has_matching_specific_location = (
-                            hotel_specific_location.lower() in taxi_specific_location.lower() or
-                            taxi_specific_location.lower() in hotel_specific_location.lower()
-                        )
-                
-                # If specific location matches, it's highly likely to be the same place
-                # If only city matches, still consider it but with lower confidence
-                locations_match = has_matching_specific_location or is_same_city
-                
-                if not locations_match:
-                    continue
-                
-                # Check if taxi departure date conflicts with hotel check-out date
-                date_difference = abs((taxi_departure_date - check_out_date).days)
+            # Check taxis arriving at the hotel (check-in conflicts), then taxis leaving it
+            # (check-out conflicts); both directions share the same matching and reporting
+            for conflict_type, taxis_by_city, hotel_time, hotel_date in (
+                ("check_in", arrivals_by_city, check_in_time, check_in_date),
+                ("check_out", departures_by_city, check_out_time, check_out_date),
+            ):
+                taxi_location_key, hotel_time_key, taxi_time_key = _CONFLICT_FIELDS[conflict_type]
+                # Formatted on the first flagged taxi only; filtering never formats times
+                hotel_time_text = None
                 
-                # Flag as conflict if dates differ by more than 0 days
-                if date_difference > 0:
-                    fraud_instances.append({
-                        "primary_event_id": hotel.event_id,
+                for (_, taxi, taxi_location, taxi_location_lower, taxi_time,
+                     taxi_date, is_late_night) in _candidate_taxis(taxis_by_city, hotel_city, hotel_location_lower):
+                    # Check if the taxi date conflicts with the hotel check-in/check-out date
+                    date_difference = abs((taxi_date - hotel_date).days)
+                    
+                    # Flag as conflict only if dates differ by more than 0 days
+                    if date_difference == 0:
+                        continue
+                    
+                    # Candidates already match the hotel by city or by name; the name check
+                    # only decides the confidence label, so it runs just for flagged pairs
+                    has_matching_specific_location = _matches_hotel_name(hotel_location_lower, taxi_location_lower)
+                    if hotel_time_text is None:
+                        hotel_time_text = hotel_time.strftime("%Y-%m-%d %H:%M")
+                    
+                    fraud_instance = {
+                        "primary_event_id": hotel_event_id,
                         "taxi_event_id": taxi.event_id,
                         "user_id": user_id,
-                        "user_name": hotel.user_name,
-                        "department": hotel.department,
-                        "conflict_type": "check_out",
+                        "user_name": hotel_user_name,
+                        "department": hotel_department,
+                        "conflict_type": conflict_type,
                         "hotel_city": hotel_city,
                         "hotel_location": hotel_specific_location,
-                        "taxi_origin": getattr(taxi_from_location, "specific_location", ""),
-                        "check_out_time": check_out_time.strftime("%Y-%m-%d %H:%M"),
-                        "taxi_departure_time": taxi_departure_time.strftime("%Y-%m-%d %H:%M"),
+                        taxi_location_key: taxi_location,
+                        hotel_time_key: hotel_time_text,
+                        taxi_time_key: taxi_time.strftime("%Y-%m-%d %H:%M"),
                         "date_difference": date_difference,
-                        "location_match_confidence": "high" if has_matching_specific_location else "medium",
-                        "hotel_amount": getattr(hotel, "amount", None),
-                        "taxi_amount": getattr(taxi, "amount", None)
-                    })
+                    }
+                    # Only arrivals get the late-night date adjustment
+                    if conflict_type == "check_in":
+                        fraud_instance["is_late_night"] = is_late_night
+                    fraud_instance["location_match_confidence"] = "high" if has_matching_specific_location else "medium"
+                    fraud_instance["hotel_amount"] = getattr(hotel, "amount", None)
+                    fraud_instance["taxi_amount"] = getattr(taxi, "amount", None)
+                    fraud_instances.append(fraud_instance)
     
     return fraud_instances if fraud_instances else False
 
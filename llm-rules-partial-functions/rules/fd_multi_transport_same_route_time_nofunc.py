@@ -1,8 +1,62 @@
 from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime, timedelta
+from collections import defaultdict
 from expensecbr.base import TrajectoryEvent, TaxiEvent, FlightEvent, RailwayEvent
 from expensecbr.fde import create_time_window_rule
 
+_EPOCH = datetime(1970, 1, 1)
+
+# Per transport class: (from location attribute, to location attribute, transport type)
+_TRANSPORT_SPECS = (
+    (TaxiEvent, ("from_location", "to_location", "Taxi")),
+    (FlightEvent, ("departure_location", "arrival_location", "Flight")),
+    (RailwayEvent, ("from_location", "to_location", "Railway")),
+)
+_transport_spec_by_type = {}
+
+
+def _resolve_transport_spec(event_type):
+    """Resolve and cache the transport spec for an event class, honouring subclasses"""
+    spec = next((spec for cls, spec in _TRANSPORT_SPECS if issubclass(event_type, cls)), ())
+    _transport_spec_by_type[event_type] = spec
+    return spec
+
+
+def _to_seconds(t):
+    """Epoch seconds for the route overlap and transfer checks"""
+    if t.tzinfo is not None:
+        return t.timestamp()
+    return (t - _EPOCH).total_seconds()
+
+
+def _overlapping_pairs(buckets, start_seconds, end_seconds):
+    """
+    Index pairs (i, j), i < j, of routes in the same bucket whose time windows overlap.
+    
+    Each bucket is sorted by start time, so a route can only overlap the routes after it
+    that start before it ends and the scan stops at the first one that does not. Works
+    only on index lists and epoch seconds; pairs are returned in (i, j) order.
+    """
+    pairs = []
+    for bucket in buckets:
+        if len(bucket) < 2:
+            continue
+        
+        bucket.sort(key=start_seconds.__getitem__)
+        bucket_starts = [start_seconds[index] for index in bucket]
+        bucket_size = len(bucket)
+        for position, first in enumerate(bucket):
+            first_end = end_seconds[first]
+            later = position + 1
+            while later < bucket_size and bucket_starts[later] <= first_end:
+                second = bucket[later]
+                pairs.append((first, second) if first < second else (second, first))
+                later += 1
+    
+    pairs.sort()
+    return pairs
+
+
 def detect_multi_transport_same_route_time(rule, events, context):
     """
     Detect when a user claims expenses for multiple transportation modes along the same route at the same time.
@@ -15,48 +69,42 @@ def detect_multi_transport_same_route_time(rule, events, context):
         return False
     
     # Group events by user_id
-    events_by_user = {}
+    events_by_user = defaultdict(list)
     for event in events:
-        if event.user_id not in events_by_user:
-            events_by_user[event.user_id] = []
         events_by_user[event.user_id].append(event)
     
     fraud_instances = []
+    # Small integer id per distinct city, so route keys hash and compare as int pairs
+    city_ids = {}
     
     for user_id, user_events in events_by_user.items():
-        # Filter for transportation events only
-        transport_events = [
-            e for e in user_events 
-            if isinstance(e, (TaxiEvent, FlightEvent, RailwayEvent))
-        ]
+        # Route details as parallel lists, one entry per usable transport event, so the
+        # pair loop below reads plain list items instead of per-route dicts. Transport
+        # events are picked out and extracted in the same pass over the user's events.
+        # Times are kept as epoch seconds for comparisons and as datetimes for reporting.
+        route_events = []
+        from_cities = []
+        to_cities = []
+        start_times = []
+        end_times = []
+        start_seconds = []
+        end_seconds = []
+        transport_types = []
+        city_pairs = []
         
-        # Skip if less than 2 transport events (need at least 2 to have a conflict)
-        if len(transport_events) < 2:
-            continue
-        
-        # Create a list of transport routes with their details
-        transport_routes = []
-        
-        for event in transport_events:
-            # Extract from/to locations and times based on event type
-            from_location = None
-            to_location = None
-            start_time = None
-            end_time = None
-            transport_type = None
+        for event in user_events:
+            # Look up how to read this event's route, skipping non-transport events
+            event_type = type(event)
+            spec = _transport_spec_by_type.get(event_type)
+            if spec is None:
+                spec = _resolve_transport_spec(event_type)
+            if not spec:
+                continue
             
-            if isinstance(event, TaxiEvent):
-                from_location = getattr(event, "from_location", None)
-                to_location = getattr(event, "to_location", None)
-                transport_type = "Taxi"
-            elif isinstance(event, FlightEvent):
-                from_location = getattr(event, "departure_location", None)
-                to_location = getattr(event, "arrival_location", None)
-                transport_type = "Flight"
-            elif isinstance(event, RailwayEvent):
-                from_location = getattr(event, "from_location", None)
-                to_location = getattr(event, "to_location", None)
-                transport_type = "Railway"
+            # Extract from/to locations based on event type
+            from_attr, to_attr, transport_type = spec
+            from_location = getattr(event, from_attr, None)
+            to_location = getattr(event, to_attr, None)
             
             # Skip events with missing location information
             if not from_location or not to_location:
@@ -68,91 +116,79 @@ def detect_multi_transport_same_route_time(rule, events, context):
             
             if not from_city or not to_city:
                 continue
-                
-            # Get start and end times (use exact times if available, otherwise use time window)
+            
+            # Add route to the lists, using exact times if available, otherwise the time window
+            route_events.append(event)
+            from_cities.append(from_city)
+            to_cities.append(to_city)
             start_time = event.time_window.exact_start_time or event.time_window.earliest_start
             end_time = event.time_window.exact_end_time or event.time_window.latest_end
+            start_times.append(start_time)
+            end_times.append(end_time)
+            start_seconds.append(_to_seconds(start_time))
+            end_seconds.append(_to_seconds(end_time))
+            transport_types.append(transport_type)
             
-            # Add route to the list
-            transport_routes.append({
-                "event_id": event.event_id,
-                "event": event,
-                "from_city": from_city,
-                "to_city": to_city,
-                "start_time": start_time,
-                "end_time": end_time,
-                "transport_type": transport_type
-            })
+            # Routes match when they connect the same two cities, regardless of direction
+            from_id = city_ids.setdefault(from_city, len(city_ids))
+            to_id = city_ids.setdefault(to_city, len(city_ids))
+            city_pairs.append((from_id, to_id) if from_id <= to_id else (to_id, from_id))
         
-        # Check each pair of transport routes for conflicts
-        for i in range(len(transport_routes)):
-            for j in range(i + 1, len(transport_routes)):
-                route1 = transport_routes[i]
-                route2 = transport_routes[j]
-                
-                # Skip if different transport types but one is taxi (taxi could be to/from airport/station)
-                if (route1["transport_type"] != route2["transport_type"] and 
-                        ("Taxi" in [route1["transport_type"], route2["transport_type"]])):
-                    # This isn't necessarily a conflict - could be taxi to airport then flight
-                    # Only check further if times suggest impossible sequence
-                    # But we'll handle this in the time overlap check below
-                    pass
-                
-                # Check if routes match (same from/to cities, regardless of order)
-                routes_match = (
-                    (route1["from_city"] == route2["from_city"] and route1["to_city"] == route2["to_city"]) or
-                    (route1["from_city"] == route2["to_city"] and route1["to_city"] == route2["from_city"])
-                )
-                
-                if not routes_match:
+        # Skip if less than 2 usable transport events (need at least 2 to have a conflict)
+        if len(route_events) < 2:
+            continue
+        
+        # Bucket route indices by their unordered city pair and only pair routes that
+        # share a bucket
+        routes_by_city_pair = defaultdict(list)
+        for i, city_pair in enumerate(city_pairs):
+            routes_by_city_pair[city_pair].append(i)
+        
+        # Every route is on a different city pair, so no two routes can match
+        if len(routes_by_city_pair) == len(route_events):
+            continue
+        
+        # Check each same-route pair with overlapping time windows for conflicts
+        for i, j in _overlapping_pairs(routes_by_city_pair.values(), start_seconds, end_seconds):
+            start1_s = start_seconds[i]
+            end1_s = end_seconds[i]
+            type1 = transport_types[i]
+            start2_s = start_seconds[j]
+            end2_s = end_seconds[j]
+            
+            # For events involving taxis and other transport, allow reasonable transfer time:
+            # a taxi ending shortly before other transport starts, or starting shortly after
+            # it ends (airport transfer), is not a conflict
+            type2 = transport_types[j]
+            if type1 != type2 and (type1 == "Taxi" or type2 == "Taxi"):
+                if 0 <= start2_s - end1_s <= 90 * 60:
                     continue
-                
-                # Check if time windows overlap
-                times_overlap = (
-                    (route1["start_time"] <= route2["end_time"]) and
-                    (route2["start_time"] <= route1["end_time"])
-                )
-                
-                # For events involving taxis and other transport, allow reasonable transfer time
-                if "Taxi" in [route1["transport_type"], route2["transport_type"]]:
-                    # If taxi is followed by other transport within reasonable time, not a conflict
-                    if route1["transport_type"] == "Taxi" and route2["transport_type"] != "Taxi":
-                        # Check if taxi ends shortly before other transport starts (airport transfer)
-                        if 0 <= (route2["start_time"] - route1["end_time"]).total_seconds() / 60 <= 90:
-                            continue
-                    elif route2["transport_type"] == "Taxi" and route1["transport_type"] != "Taxi":
-                        # Check if taxi starts shortly after other transport ends (airport transfer)
-                        if 0 <= (route2["start_time"] - route1["end_time"]).total_seconds() / 60 <= 90:
-                            continue
-                
-                if routes_match and times_overlap:
-                    # This is a conflict - user claimed multiple transports on same route at same time
-                    event1 = route1["event"]
-                    event2 = route2["event"]
-                    
-                    # Calculate the length of the overlap
-                    overlap_start = max(route1["start_time"], route2["start_time"])
-                    overlap_end = min(route1["end_time"], route2["end_time"])
-                    overlap_minutes = (overlap_end - overlap_start).total_seconds() / 60
-                    
-                    fraud_instances.append({
-                        "primary_event_id": event1.event_id,
-                        "secondary_event_id": event2.event_id,
-                        "user_id": user_id,
-                        "user_name": event1.user_name,
-                        "department": event1.department,
-                        "from_city": route1["from_city"],
-                        "to_city": route1["to_city"],
-                        "transport1_type": route1["transport_type"],
-                        "transport2_type": route2["transport_type"],
-                        "transport1_start": route1["start_time"].strftime("%Y-%m-%d %H:%M"),
-                        "transport1_end": route1["end_time"].strftime("%Y-%m-%d %H:%M"),
-                        "transport2_start": route2["start_time"].strftime("%Y-%m-%d %H:%M"),
-                        "transport2_end": route2["end_time"].strftime("%Y-%m-%d %H:%M"),
-                        "overlap_minutes": round(overlap_minutes),
-                        "transport1_amount": getattr(event1, "amount", None),
-                        "transport2_amount": getattr(event2, "amount", None),
-                    })
+            
+            # This is a conflict - user claimed multiple transports on same route at same time
+            event1 = route_events[i]
+            event2 = route_events[j]
+            
+            # Calculate the length of the overlap
+            overlap_minutes = (min(end1_s, end2_s) - max(start1_s, start2_s)) / 60
+            
+            fraud_instances.append({
+                "primary_event_id": event1.event_id,
+                "secondary_event_id": event2.event_id,
+                "user_id": user_id,
+                "user_name": event1.user_name,
+                "department": event1.department,
+                "from_city": from_cities[i],
+                "to_city": to_cities[i],
+                "transport1_type": type1,
+                "transport2_type": type2,
+                "transport1_start": start_times[i].strftime("%Y-%m-%d %H:%M"),
+                "transport1_end": end_times[i].strftime("%Y-%m-%d %H:%M"),
+                "transport2_start": start_times[j].strftime("%Y-%m-%d %H:%M"),
+                "transport2_end": end_times[j].strftime("%Y-%m-%d %H:%M"),
+                "overlap_minutes": round(overlap_minutes),
+                "transport1_amount": getattr(event1, "amount", None),
+                "transport2_amount": getattr(event2, "amount", None),
+            })
     
     return fraud_instances if fraud_instances else False
 
@@ -175,13 +211,6 @@ def format_multi_transport_alert(rule, events, extra_data, context):
     transport1_amount = extra_data.get("transport1_amount")
     transport2_amount = extra_data.get("transport2_amount")
     
-    # Find the events
-    primary_event_id = extra_data.get("primary_event_id")
-    secondary_event_id = extra_data.get("secondary_event_id")
-    
-    primary_event = next((e for e in events if e.event_id == primary_event_id), None)
-    secondary_event = next((e for e in events if e.event_id == secondary_event_id), None)
-    
     title = f"Multiple Transport Claims: {transport1_type} and {transport2_type} on Same Route"
     
     details = (
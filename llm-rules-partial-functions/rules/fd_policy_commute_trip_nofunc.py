@@ -1,8 +1,33 @@
 from typing import Dict, Any, List, Optional
-from datetime import datetime, timedelta, time
+from datetime import time
+from functools import lru_cache
 from expensecbr.base import TrajectoryEvent, TaxiEvent, Location
 from expensecbr.fde import create_individual_rule
 
+# Late night commutes (after 10:30 PM) are allowed by policy
+LATE_NIGHT_THRESHOLD = time(22, 30)
+
+# Commuting is expected within this many minutes before work starts or after it ends
+COMMUTE_BUFFER_MINUTES = 90
+
+
+@lru_cache(maxsize=16)
+def _buffered_bounds(work_start_hour, work_end_hour, buffer_minutes=COMMUTE_BUFFER_MINUTES):
+    """
+    (before-work earliest, work start, work end, after-work latest) times of day for the
+    given working hours.
+    
+    Buffered bounds wrap around midnight like datetime arithmetic on the event date would.
+    """
+    work_start_time = time(work_start_hour, 0)
+    work_end_time = time(work_end_hour, 0)
+    
+    before_work_earliest_time = time(*divmod((work_start_hour * 60 - buffer_minutes) % 1440, 60))
+    after_work_latest_time = time(*divmod((work_end_hour * 60 + buffer_minutes) % 1440, 60))
+    
+    return before_work_earliest_time, work_start_time, work_end_time, after_work_latest_time
+
+
 def detect_commute_taxi_usage(rule, events, context):
     """
     Detect employees using taxis for regular commuting between home and workplace during workdays.
@@ -21,6 +46,46 @@ def detect_commute_taxi_usage(rule, events, context):
     if not isinstance(event, TaxiEvent):
         return False
     
+    # Time checks come first: they only read the event itself, and most taxi rides fail
+    # one of them before any location needs to be looked up
+    
+    # Check if this is during a workday (Monday-Friday)
+    event_time = event.time_window.earliest_start
+    is_workday = event_time.weekday() < 5  # 0-4 are Monday-Friday
+    
+    if not is_workday:
+        return False  # Weekend travel is allowed
+    
+    # Check if this is during normal business hours
+    # Late night commutes (after 10:30 PM) are allowed by policy
+    event_time_only = event_time.time()
+    is_late_night = event_time_only >= LATE_NIGHT_THRESHOLD
+    
+    if is_late_night:
+        return False  # Late night commutes are allowed
+    
+    # Get working hours from context
+    working_hours = context.get("working_hours", {"start": 9, "end": 18})
+    work_start_hour = working_hours.get("start", 9)
+    work_end_hour = working_hours.get("end", 18)
+    
+    # Commute window bounds for these working hours (computed once per distinct setting)
+    before_work_earliest_time, work_start_time, work_end_time, after_work_latest_time = _buffered_bounds(
+        work_start_hour, work_end_hour
+    )
+    
+    # Check if the commute is during typical commuting hours
+    
+    # Morning commute: from buffer before work start time
+    is_morning_commute = before_work_earliest_time <= event_time_only <= work_start_time
+    
+    # Evening commute: until buffer after work end time
+    is_evening_commute = work_end_time <= event_time_only <= after_work_latest_time
+    
+    # If it's neither a morning nor evening commute during buffer times, it's policy violation
+    if not (is_morning_commute or is_evening_commute):
+        return False  # Not during typical commuting hours
+    
     # Get user's home and work locations from context
     home_locations = context.get("default_home_locations", {})
     work_locations = context.get("default_work_locations", {})
@@ -61,54 +126,6 @@ def detect_commute_taxi_usage(rule, events, context):
     if not is_commute_trip:
         return False  # Not a commute trip
     
-    # Check if this is during a workday (Monday-Friday)
-    event_time = event.time_window.earliest_start
-    is_workday = event_time.weekday() < 5  # 0-4 are Monday-Friday
-    
-    if not is_workday:
-        return False  # Weekend travel is allowed
-    
-    # Check if this is during normal business hours
-    # Late night commutes (after 10:30 PM) are allowed by policy
-    late_night_threshold = time(22, 30)  # 10:30 PM
-    is_late_night = event_time.time() >= late_night_threshold
-    
-    if is_late_night:
-        return False  # Late night commutes are allowed
-    
-    # Get working hours from context
-    working_hours = context.get("working_hours", {"start": 9, "end": 18})
-    work_start_hour = working_hours.get("start", 9)
-    work_end_hour = working_hours.get("end", 18)
-    
-    # Allow commuting slightly before work starts or after work ends
-    # (within 90 minutes buffer)
-    buffer_minutes = 90
-    
-    work_start_time = time(work_start_hour, 0)
-    work_end_time = time(work_end_hour, 0)
-    
-    # Calculate buffer times
-    before_work_earliest = datetime.combine(event_time.date(), work_start_time) - timedelta(minutes=buffer_minutes)
-    after_work_latest = datetime.combine(event_time.date(), work_end_time) + timedelta(minutes=buffer_minutes)
-    
-    # Convert to time objects for comparison
-    before_work_earliest_time = before_work_earliest.time()
-    after_work_latest_time = after_work_latest.time()
-    
-    # Check if the commute is during typical commuting hours
-    event_time_only = event_time.time()
-    
-    # Morning commute: from buffer before work start time
-    is_morning_commute = before_work_earliest_time <= event_time_only <= work_start_time
-    
-    # Evening commute: until buffer after work end time
-    is_evening_commute = work_end_time <= event_time_only <= after_work_latest_time
-    
-    # If it's neither a morning nor evening commute during buffer times, it's policy violation
-    if not (is_morning_commute or is_evening_commute):
-        return False  # Not during typical commuting hours
-    
     # At this point, we have a commute trip violation
     return {
         "primary_event_id": event.event_id,
@@ -1,8 +1,74 @@
 from typing import Dict, Any, List, Optional, Set
 from datetime import datetime, timedelta
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import combinations
+from operator import itemgetter
 from expensecbr.base import TrajectoryEvent, TaxiEvent, FlightEvent, RailwayEvent
 from expensecbr.fde import create_time_window_rule
 
+_EPOCH = datetime(1970, 1, 1)
+
+# Per event class: (is taxi, from location attribute, to location attribute). Taxis are
+# bucketed by city; flights and railway are the intercity transports between cities
+_EVENT_SPECS = (
+    (TaxiEvent, (True, None, None)),
+    (FlightEvent, (False, "departure_location", "arrival_location")),
+    (RailwayEvent, (False, "from_location", "to_location")),
+)
+_event_spec_by_type = {}
+
+
+def _resolve_event_spec(event_type):
+    """Resolve and cache the spec for an event class, honouring subclasses"""
+    spec = next((spec for cls, spec in _EVENT_SPECS if issubclass(event_type, cls)), ())
+    _event_spec_by_type[event_type] = spec
+    return spec
+
+
+def _to_seconds(t):
+    """Epoch seconds for the taxi bounds and transport gap checks"""
+    if t.tzinfo is not None:
+        return t.timestamp()
+    return (t - _EPOCH).total_seconds()
+
+
+def _transport_route(transport, from_attr, to_attr):
+    """
+    (from location, to location, start seconds, end seconds) for an intercity transport,
+    or None when either location is missing
+    """
+    from_location = getattr(transport, from_attr, None)
+    to_location = getattr(transport, to_attr, None)
+    
+    # Skip if location info is missing
+    if not from_location or not to_location:
+        return None
+    
+    time_window = transport.time_window
+    return from_location, to_location, _to_seconds(time_window.earliest_start), _to_seconds(time_window.latest_end)
+
+
+def _has_transport_between(transport_starts, transport_ends, gap_start, gap_end):
+    """
+    Whether any transport lies entirely within [gap_start, gap_end].
+    
+    Takes transport start/end epoch seconds as parallel lists sorted by start. Scans only
+    transports starting at or after the gap start; once one starts after the gap end, it
+    and every later one also end after it.
+    """
+    if gap_start >= gap_end:
+        return False
+    
+    index = bisect_left(transport_starts, gap_start)
+    transport_count = len(transport_starts)
+    while index < transport_count and transport_starts[index] <= gap_end:
+        if transport_ends[index] <= gap_end:
+            return True
+        index += 1
+    return False
+
+
 def detect_taxi_multicity_no_intercity(rule, events, context):
     """
     Detect users taking taxis in multiple cities without intercity transportation records.
@@ -15,118 +81,111 @@ def detect_taxi_multicity_no_intercity(rule, events, context):
     if not events:
         return False
     
-    # Group events by user_id
-    events_by_user = {}
+    # Group events by user_id, splitting each user's events in the same pass into taxi
+    # events by city and intercity transport routes (flights, railway)
+    user_data = defaultdict(lambda: (defaultdict(list), []))
     for event in events:
-        if event.user_id not in events_by_user:
-            events_by_user[event.user_id] = []
-        events_by_user[event.user_id].append(event)
+        city_to_events, transport_routes = user_data[event.user_id]
+        
+        # Look up how to handle this event's class, skipping other event types
+        event_type = type(event)
+        spec = _event_spec_by_type.get(event_type)
+        if spec is None:
+            spec = _resolve_event_spec(event_type)
+        if not spec:
+            continue
+        
+        is_taxi, from_attr, to_attr = spec
+        if is_taxi:
+            # Get the city from location
+            city = event.location.city if event.location else None
+            if not city:
+                continue
+            
+            # Keep the taxi with its start and end times, read once here
+            time_window = event.time_window
+            city_to_events[city].append((time_window.earliest_start, time_window.latest_end, event))
+        
+        else:
+            # Intercity transport (flights, railway): keep only its route and times
+            transport_route = _transport_route(event, from_attr, to_attr)
+            if transport_route:
+                transport_routes.append(transport_route)
     
     fraud_instances = []
     
-    for user_id, user_events in events_by_user.items():
-        # Filter for taxi events
-        taxi_events = [e for e in user_events if isinstance(e, TaxiEvent)]
-        
-        # Skip if less than 2 taxi events (can't be in multiple cities)
-        if len(taxi_events) < 2:
+    for user_id, (city_to_events, transport_routes) in user_data.items():
+        # Skip if taxi events are in less than 2 cities
+        if len(city_to_events) < 2:
             continue
         
-        # Sort taxi events by earliest start time
-        taxi_events.sort(key=lambda e: e.time_window.earliest_start)
+        # Sort each city's (start, end, taxi) rows by earliest start time, and get the
+        # earliest and latest taxi time in each city once, as epoch seconds
+        city_bounds = {}
+        for city, city_taxis in city_to_events.items():
+            city_taxis.sort(key=itemgetter(0))
+            city_bounds[city] = (_to_seconds(city_taxis[0][0]), _to_seconds(city_taxis[-1][1]))
         
-        # Extract city information from taxi events
-        cities_visited = set()
-        city_to_events = {}
+        # Each unordered pair once, as (city1, city2) with city1 < city2, in a stable order
+        cities_visited = sorted(city_to_events)
         
-        for taxi in taxi_events:
-            # Get the city from location
-            city = taxi.location.city if taxi.location else None
-            if not city:
+        # Index intercity transports by the unordered pair of visited cities they connect,
+        # as start and end epoch seconds sorted by start, so each city pair below only looks
+        # at the transports between its own two cities. Endpoints are matched to cities
+        # with Location.is_same_city, once per transport and city rather than per city pair
+        transport_times_by_city_pair = {}
+        for from_location, to_location, start_seconds, end_seconds in transport_routes:
+            from_cities = [city for city in cities_visited if from_location.is_same_city(city)]
+            if not from_cities:
                 continue
-                
-            cities_visited.add(city)
-            if city not in city_to_events:
-                city_to_events[city] = []
-            city_to_events[city].append(taxi)
+            to_cities = [city for city in cities_visited if to_location.is_same_city(city)]
+            for from_city in from_cities:
+                for to_city in to_cities:
+                    if from_city == to_city:
+                        continue
+                    city_pair = (from_city, to_city) if from_city < to_city else (to_city, from_city)
+                    transport_times_by_city_pair.setdefault(city_pair, []).append((start_seconds, end_seconds))
         
-        # Skip if only one city found
-        if len(cities_visited) < 2:
-            continue
-            
-        # Find all intercity transport events (flights, railway)
-        intercity_events = [e for e in user_events if isinstance(e, (FlightEvent, RailwayEvent))]
+        for city_pair, transport_times in transport_times_by_city_pair.items():
+            transport_times.sort(key=itemgetter(0))
+            transport_times_by_city_pair[city_pair] = (
+                [start for start, _ in transport_times],
+                [end for _, end in transport_times],
+            )
         
         # For each pair of cities with taxi events, check if there's a valid intercity transport
         suspicious_city_pairs = []
         
-        for city1 in cities_visited:
-            for city2 in cities_visited:
-                if city1 >= city2:  # Skip same city and avoid duplicates
-                    continue
-                    
-                # Get earliest and latest taxi events in each city
-                city1_taxis = sorted(city_to_events[city1], key=lambda e: e.time_window.earliest_start)
-                city2_taxis = sorted(city_to_events[city2], key=lambda e: e.time_window.earliest_start)
-                
-                earliest_city1 = city1_taxis[0].time_window.earliest_start
-                latest_city1 = city1_taxis[-1].time_window.latest_end
-                
-                earliest_city2 = city2_taxis[0].time_window.earliest_start
-                latest_city2 = city2_taxis[-1].time_window.latest_end
-                
-                # Check if we have intercity transport between the cities
-                has_transport = False
-                
-                for transport in intercity_events:
-                    # Extract from and to cities based on event type
-                    from_city = None
-                    to_city = None
-                    
-                    if isinstance(transport, FlightEvent):
-                        from_city = getattr(transport, "departure_location", None)
-                        to_city = getattr(transport, "arrival_location", None)
-                    elif isinstance(transport, RailwayEvent):
-                        from_city = getattr(transport, "from_location", None)
-                        to_city = getattr(transport, "to_location", None)
-                    
-                    # Skip if location info is missing
-                    if not from_city or not to_city:
-                        continue
-                        
-                    # Check if this transport connects our two cities
-                    connects_cities = (
-                        (from_city.is_same_city(city1) and to_city.is_same_city(city2)) or
-                        (from_city.is_same_city(city2) and to_city.is_same_city(city1))
-                    )
-                    
-                    if connects_cities:
-                        # Check if the timing makes sense
-                        transport_start = transport.time_window.earliest_start
-                        transport_end = transport.time_window.latest_end
-                        
-                        # The transport must be between the earliest taxi in one city
-                        # and the earliest taxi in the other city
-                        connects_timeframes = False
-                        
-                        # City1 then City2
-                        if latest_city1 < earliest_city2 and transport_start >= latest_city1 and transport_end <= earliest_city2:
-                            connects_timeframes = True
-                            
-                        # City2 then City1  
-                        if latest_city2 < earliest_city1 and transport_start >= latest_city2 and transport_end <= earliest_city1:
-                            connects_timeframes = True
-                            
-                        if connects_timeframes:
-                            has_transport = True
-                            break
-                
-                # If no valid transport found, add to suspicious pairs
-                if not has_transport:
-                    suspicious_city_pairs.append((city1, city2))
+        for city1, city2 in combinations(cities_visited, 2):
+            earliest_city1, latest_city1 = city_bounds[city1]
+            earliest_city2, latest_city2 = city_bounds[city2]
+            
+            # Check if we have intercity transport between the cities. The transport must
+            # be between the latest taxi in one city and the earliest taxi in the other
+            # city: City1 then City2, or City2 then City1
+            has_transport = False
+            
+            transport_times = transport_times_by_city_pair.get((city1, city2))
+            if transport_times:
+                transport_starts, transport_ends = transport_times
+                has_transport = (
+                    _has_transport_between(transport_starts, transport_ends, latest_city1, earliest_city2) or
+                    _has_transport_between(transport_starts, transport_ends, latest_city2, earliest_city1)
+                )
+            
+            # If no valid transport found, add to suspicious pairs
+            if not has_transport:
+                suspicious_city_pairs.append((city1, city2))
         
         # If suspicious city pairs found, report fraud for this user
         if suspicious_city_pairs:
+            # Taxi dates per city, formatted once per city rather than once per pair it is in
+            city_dates = {}
+            for city_pair in suspicious_city_pairs:
+                for city in city_pair:
+                    if city not in city_dates:
+                        city_dates[city] = [start.strftime("%Y-%m-%d") for start, _, _ in city_to_events[city]]
+            
             # Create a fraud instance for each suspicious city pair
             for city1, city2 in suspicious_city_pairs:
                 # Get relevant taxi events for evidence
@@ -134,11 +193,11 @@ def detect_taxi_multicity_no_intercity(rule, events, context):
                 city2_taxis = city_to_events[city2]
                 
                 # Use the first taxi event in each city as primary evidence
-                primary_city1_event = city1_taxis[0]
-                primary_city2_event = city2_taxis[0]
+                primary_city1_start, _, primary_city1_event = city1_taxis[0]
+                primary_city2_start, _, primary_city2_event = city2_taxis[0]
                 
                 # Use the earliest taxi as the primary event
-                primary_event = primary_city1_event if primary_city1_event.time_window.earliest_start <= primary_city2_event.time_window.earliest_start else primary_city2_event
+                primary_event = primary_city1_event if primary_city1_start <= primary_city2_start else primary_city2_event
                 
                 fraud_instances.append({
                     "primary_event_id": primary_event.event_id,
@@ -147,10 +206,10 @@ def detect_taxi_multicity_no_intercity(rule, events, context):
                     "department": primary_event.department,
                     "city1": city1,
                     "city2": city2,
-                    "city1_event_ids": [e.event_id for e in city1_taxis],
-                    "city2_event_ids": [e.event_id for e in city2_taxis],
-                    "city1_dates": [e.time_window.earliest_start.strftime("%Y-%m-%d") for e in city1_taxis],
-                    "city2_dates": [e.time_window.earliest_start.strftime("%Y-%m-%d") for e in city2_taxis],
+                    "city1_event_ids": [taxi.event_id for _, _, taxi in city1_taxis],
+                    "city2_event_ids": [taxi.event_id for _, _, taxi in city2_taxis],
+                    "city1_dates": list(city_dates[city1]),
+                    "city2_dates": list(city_dates[city2]),
                 })
     
     return fraud_instances if fraud_instances else False
@@ -167,10 +226,6 @@ def format_taxi_multicity_no_intercity_alert(rule, events, extra_data, context):
     city1_dates = extra_data.get("city1_dates", [])
     city2_dates = extra_data.get("city2_dates", [])
     
-    # Find the primary event
-    primary_event_id = extra_data.get("primary_event_id")
-    primary_event = next((e for e in events if e.event_id == primary_event_id), None)
-    
     # Format dates for display
     city1_dates_str = ", ".join(city1_dates)
     city2_dates_str = ", ".join(city2_dates)
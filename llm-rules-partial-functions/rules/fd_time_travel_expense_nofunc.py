@@ -3,6 +3,11 @@ from datetime import datetime, timedelta
 from expensecbr.base import TrajectoryEvent
 from expensecbr.fde import create_individual_rule
 
+# Submissions less than this far ahead of the event are treated as timing noise
+MIN_TIME_IN_ADVANCE_HOURS = 0.01  # 36 seconds
+_MIN_TIME_IN_ADVANCE = timedelta(hours=MIN_TIME_IN_ADVANCE_HOURS)
+
+
 def detect_time_travel_expense(rule, events, context):
     """
     Detect expenses that have been submitted for reimbursement before they actually occurred.
@@ -28,29 +33,27 @@ def detect_time_travel_expense(rule, events, context):
     # Get the event's time window for when the expense actually occurred
     event_start_time = event.time_window.earliest_start
     
-    # Check if submission time is before the event's start time
-    if submission_time < event_start_time:
-        # Calculate how far in advance the submission was made
-        time_difference = (event_start_time - submission_time).total_seconds() / 3600  # hours
-        
-        # If the difference is negligible (e.g., a few seconds due to system timing issues),
-        # we should ignore it to prevent false positives
-        if time_difference < 0.01:  # Less than 36 seconds
-            return False
-        
-        return {
-            "primary_event_id": event.event_id,
-            "user_id": event.user_id,
-            "user_name": event.user_name,
-            "department": event.department,
-            "event_type": type(event).__name__,
-            "submission_time": submission_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "event_time": event_start_time.strftime("%Y-%m-%d %H:%M:%S"),
-            "time_difference_hours": round(time_difference, 2),
-            "amount": getattr(event, "amount", None)
-        }
-    
-    return False
+    # Check if submission time is before the event's start time. If the difference is
+    # negligible (e.g., a few seconds due to system timing issues), we should ignore it
+    # to prevent false positives
+    time_in_advance = event_start_time - submission_time
+    if time_in_advance < _MIN_TIME_IN_ADVANCE:
+        return False
+    
+    # Calculate how far in advance the submission was made
+    time_difference = time_in_advance.total_seconds() / 3600  # hours
+    
+    return {
+        "primary_event_id": event.event_id,
+        "user_id": event.user_id,
+        "user_name": event.user_name,
+        "department": event.department,
+        "event_type": type(event).__name__,
+        "submission_time": submission_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "event_time": event_start_time.strftime("%Y-%m-%d %H:%M:%S"),
+        "time_difference_hours": round(time_difference, 2),
+        "amount": getattr(event, "amount", None)
+    }
 
 
 def format_time_travel_alert(rule, events, extra_data, context):
@@ -70,36 +73,38 @@ def format_time_travel_alert(rule, events, extra_data, context):
     primary_event = next((e for e in events if e.event_id == primary_event_id), None)
     
     # Get event-specific details
-    event_details = ""
+    event_details = []
     if primary_event:
         # Add location information if available
         if hasattr(primary_event, "location") and primary_event.location:
             location = primary_event.location
             city = location.city if hasattr(location, "city") else "Unknown"
             specific_loc = location.specific_location if hasattr(location, "specific_location") else ""
-            event_details += f"Location: {city} {specific_loc}\n"
+            event_details.append(f"Location: {city} {specific_loc}\n")
         
         # Add event-specific fields based on event type
         if hasattr(primary_event, "remark") and primary_event.remark:
-            event_details += f"Remark: {primary_event.remark}\n"
+            event_details.append(f"Remark: {primary_event.remark}\n")
     
     title = f"Time Paradox: Expense Submitted {time_difference} Hours Before Occurrence"
     
-    details = (
+    # Collect the optional sections as fragments and join them once
+    details_parts = [
         f"User {user_name} ({user_id}) from {department} submitted a reimbursement request "
         f"for a {event_type} before the expense actually occurred.\n\n"
         f"Submission time: {submission_time}\n"
         f"Actual event time: {event_time}\n"
         f"Time difference: {time_difference} hours\n"
-    )
+    ]
     
     if amount is not None:
-        details += f"Amount: {amount} yuan\n"
+        details_parts.append(f"Amount: {amount} yuan\n")
     
     if event_details:
-        details += f"\nAdditional details:\n{event_details}"
+        details_parts.append("\nAdditional details:\n")
+        details_parts.extend(event_details)
     
-    details += (
+    details_parts.append(
         f"\nThis activity is suspicious because it's impossible to submit a reimbursement "
         f"for an expense that hasn't happened yet. This could indicate:"
         f"\n- Fraudulent backdating of expenses"
@@ -107,6 +112,8 @@ def format_time_travel_alert(rule, events, extra_data, context):
         f"\n- Severe data entry or system timestamp errors"
     )
     
+    details = "".join(details_parts)
+    
     return {"title": title, "details": details}
 
 
@@ -1,9 +1,15 @@
+import sys
 from typing import Dict, Any, List, Optional, Set, Tuple
 from datetime import datetime, timedelta, date
 from collections import defaultdict
+from functools import lru_cache
+from itertools import combinations
+from operator import itemgetter
 from expensecbr.base import TrajectoryEvent
 from expensecbr.fde import create_daily_rule
 
+_EPOCH = datetime(1970, 1, 1)
+
 # Approximate distances between major Chinese cities in kilometers
 # These are sample distances - a more comprehensive map would be needed in production
 CITY_DISTANCES = {
@@ -24,20 +30,77 @@ CITY_DISTANCES = {
     ("成都市", "武汉市"): 1043,
 }
 
+# Both orientations of every city pair, so a distance is a single lookup; a pair listed
+# directly takes precedence over the reverse of another entry
+_CITY_DISTANCE_LOOKUP = {
+    **{(city2, city1): distance for (city1, city2), distance in CITY_DISTANCES.items()},
+    **CITY_DISTANCES,
+}
+
 # Maximum reasonable travel distance in a day (without specialized transportation)
 MAX_REASONABLE_DAILY_TRAVEL_KM = 1200  # Approximate distance covered by high-speed train in a day
 
 def get_city_distance(city1: str, city2: str) -> float:
     """Get the approximate distance between two cities in kilometers."""
-    # Try to get the distance from our predefined map
-    if (city1, city2) in CITY_DISTANCES:
-        return CITY_DISTANCES[(city1, city2)]
-    if (city2, city1) in CITY_DISTANCES:
-        return CITY_DISTANCES[(city2, city1)]
-        
-    # If we don't have this city pair, use a default large distance for unknown pairs
+    # Get the distance from our predefined map, or a default large distance for unknown pairs
     # In a real system, we'd use a more comprehensive distance database or API
-    return float('inf')
+    return _CITY_DISTANCE_LOOKUP.get((city1, city2), float('inf'))
+
+@lru_cache(maxsize=4096)
+def _far_city_pairs(cities: Tuple[str, ...]) -> Tuple[Tuple[str, str, float], ...]:
+    """
+    (city1, city2, distance) for the pairs of cities further apart than the reasonable
+    daily travel limit; only these need the timing check.
+    
+    Cached on the day's cities in the order they were visited, so repeat itineraries
+    reuse the result and each pair keeps the orientation it is reported in.
+    """
+    far_city_pairs = []
+    for city1, city2 in combinations(cities, 2):
+        # Calculate distance between cities
+        distance = get_city_distance(city1, city2)
+        
+        # If distance exceeds the reasonable daily travel limit
+        if distance > MAX_REASONABLE_DAILY_TRAVEL_KM:
+            far_city_pairs.append((city1, city2, distance))
+    return tuple(far_city_pairs)
+
+def _city_of(location):
+    """City name of an event location, interned, or None when it is missing"""
+    city = location.city if location else None
+    # Interned so the per-day city keys, and the far-pair cache keys built from them,
+    # compare equal names by identity; non-string cities are used as they are
+    if isinstance(city, str) and city:
+        return sys.intern(city)
+    return city or None
+
+def _to_seconds(t):
+    """Epoch seconds of a city's earliest or latest activity"""
+    if t.tzinfo is not None:
+        return t.timestamp()
+    return (t - _EPOCH).total_seconds()
+
+def _impossible_travel_hours(distance, city1_earliest_s, city1_latest_s, city2_earliest_s, city2_latest_s):
+    """
+    Minimum travel hours between two cities when the time between the activities in them
+    is too short to travel in either direction, otherwise None.
+    
+    Works only on the distance and the two cities' activity bounds in epoch seconds, so
+    the pair scan does no attribute access or datetime arithmetic here.
+    """
+    # Calculate time difference between latest event in city1 and earliest in city2
+    # and vice versa
+    time_diff1 = abs(city2_earliest_s - city1_latest_s) / 3600  # hours
+    time_diff2 = abs(city1_earliest_s - city2_latest_s) / 3600  # hours
+    
+    # Estimate minimum travel time (assume 300 km/h for high-speed rail as best case)
+    min_travel_hours = distance / 300
+    
+    # If minimum travel time exceeds available time between events,
+    # the travel pattern is physically impossible
+    if time_diff1 < min_travel_hours and time_diff2 < min_travel_hours:
+        return min_travel_hours
+    return None
 
 def detect_ubiquitous_presence(rule, events, context):
     """
@@ -62,12 +125,14 @@ def detect_ubiquitous_presence(rule, events, context):
         if len(user_events) < 2:
             continue
         
-        # Group events by date
+        # Group events by date, as (start, end, event) rows so each event's time window
+        # is read once here
         events_by_date = defaultdict(list)
         for event in user_events:
             # Extract the date from the event's time window
-            event_date = event.time_window.earliest_start.date()
-            events_by_date[event_date].append(event)
+            time_window = event.time_window
+            start_time = time_window.earliest_start
+            events_by_date[start_time.date()].append((start_time, time_window.latest_end, event))
         
         # For each date, check if user appears in distant cities
         for event_date, daily_events in events_by_date.items():
@@ -76,81 +141,76 @@ def detect_ubiquitous_presence(rule, events, context):
                 continue
             
             # Extract unique cities visited on this date
-            cities_visited = {}  # city -> list of events
+            cities_visited = defaultdict(list)  # city -> list of (start, end, event) rows
             
-            for event in daily_events:
+            for daily_event in daily_events:
                 # Skip events without location information
-                if not hasattr(event, 'location') or not event.location or not event.location.city:
+                event = daily_event[2]
+                city = _city_of(getattr(event, 'location', None))
+                if not city:
                     continue
                 
-                city = event.location.city
-                if city not in cities_visited:
-                    cities_visited[city] = []
-                cities_visited[city].append(event)
+                cities_visited[city].append(daily_event)
             
             # Skip if user didn't visit multiple cities
             if len(cities_visited) < 2:
                 continue
             
-            # Check all pairs of cities
+            # Find the city pairs whose distance exceeds the reasonable daily travel limit
+            far_city_pairs = _far_city_pairs(tuple(cities_visited))
+            if not far_city_pairs:
+                continue
+            
+            # Sort the events of each city in a distant pair by time once, and get the
+            # earliest and latest times in each: the first event's start and the last
+            # event's end, as datetimes for reporting and epoch seconds for the check
+            city_bounds = {}
+            for city_pair in far_city_pairs:
+                for city in city_pair[:2]:
+                    if city not in city_bounds:
+                        city_events = cities_visited[city]
+                        city_events.sort(key=itemgetter(0))
+                        city_earliest = city_events[0][0]
+                        city_latest = city_events[-1][1]
+                        city_bounds[city] = (
+                            city_earliest, city_latest, _to_seconds(city_earliest), _to_seconds(city_latest)
+                        )
+            
+            # Check if the timing makes each distant pair physically impossible
             impossible_city_pairs = []
             
-            cities = list(cities_visited.keys())
-            for i in range(len(cities)):
-                for j in range(i+1, len(cities)):
-                    city1 = cities[i]
-                    city2 = cities[j]
-                    
-                    # Calculate distance between cities
-                    distance = get_city_distance(city1, city2)
+            for city1, city2, distance in far_city_pairs:
+                # Get earliest and latest times in each city
+                city1_earliest, city1_latest, city1_earliest_s, city1_latest_s = city_bounds[city1]
+                city2_earliest, city2_latest, city2_earliest_s, city2_latest_s = city_bounds[city2]
+                
+                # Minimum travel time if the timing makes this physically impossible
+                min_travel_hours = _impossible_travel_hours(
+                    distance, city1_earliest_s, city1_latest_s, city2_earliest_s, city2_latest_s
+                )
+                
+                if min_travel_hours is not None:
+                    # Get the events in each city
+                    city1_events = cities_visited[city1]
+                    city2_events = cities_visited[city2]
                     
-                    # If distance exceeds the reasonable daily travel limit
-                    if distance > MAX_REASONABLE_DAILY_TRAVEL_KM:
-                        # Get the events in each city
-                        city1_events = cities_visited[city1]
-                        city2_events = cities_visited[city2]
-                        
-                        # Check if the timing makes this physically impossible
-                        # Sort events by time
-                        city1_events.sort(key=lambda e: e.time_window.earliest_start)
-                        city2_events.sort(key=lambda e: e.time_window.earliest_start)
-                        
-                        # Get earliest and latest times in each city
-                        city1_earliest = city1_events[0].time_window.earliest_start
-                        city1_latest = city1_events[-1].time_window.latest_end
-                        city2_earliest = city2_events[0].time_window.earliest_start
-                        city2_latest = city2_events[-1].time_window.latest_end
-                        
-                        # Calculate time difference between latest event in city1 and earliest in city2
-                        # and vice versa
-                        time_diff1 = abs((city2_earliest - city1_latest).total_seconds() / 3600)  # hours
-                        time_diff2 = abs((city1_earliest - city2_latest).total_seconds() / 3600)  # hours
-                        
-                        # Estimate minimum travel time (assume 300 km/h for high-speed rail as best case)
-                        min_travel_hours = distance / 300
-                        
-                        # If minimum travel time exceeds available time between events,
-                        # the travel pattern is physically impossible
-                        impossible = (time_diff1 < min_travel_hours and time_diff2 < min_travel_hours)
-                        
-                        if impossible:
-                            impossible_city_pairs.append({
-                                "city1": city1,
-                                "city2": city2,
-                                "distance": distance,
-                                "min_travel_hours": min_travel_hours,
-                                "city1_event_ids": [e.event_id for e in city1_events],
-                                "city2_event_ids": [e.event_id for e in city2_events],
-                                "city1_earliest": city1_earliest,
-                                "city1_latest": city1_latest,
-                                "city2_earliest": city2_earliest,
-                                "city2_latest": city2_latest,
-                            })
+                    impossible_city_pairs.append({
+                        "city1": city1,
+                        "city2": city2,
+                        "distance": distance,
+                        "min_travel_hours": min_travel_hours,
+                        "city1_event_ids": [e.event_id for _, _, e in city1_events],
+                        "city2_event_ids": [e.event_id for _, _, e in city2_events],
+                        "city1_earliest": city1_earliest,
+                        "city1_latest": city1_latest,
+                        "city2_earliest": city2_earliest,
+                        "city2_latest": city2_latest,
+                    })
             
             # If impossible city pairs found, report fraud
             if impossible_city_pairs:
                 # Create a sample event for reference
-                sample_event = daily_events[0]
+                sample_event = daily_events[0][2]
                 
                 # Create a report for this day's impossible travel
                 fraud_instances.append({
@@ -176,10 +236,6 @@ def format_ubiquitous_presence_alert(rule, events, extra_data, context):
     impossible_city_pairs = extra_data.get("impossible_city_pairs", [])
     num_cities = extra_data.get("num_cities_visited", 0)
     
-    # Find the primary event
-    primary_event_id = extra_data.get("primary_event_id")
-    primary_event = next((e for e in events if e.event_id == primary_event_id), None)
-    
     # Format title
     title = f"Impossible Travel Pattern: {num_cities} Cities in One Day"
     
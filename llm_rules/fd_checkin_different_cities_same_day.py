@@ -1,5 +1,6 @@
 from typing import Dict, Any, List, Tuple
 from datetime import datetime, timedelta
+from collections import defaultdict
 
 from expensecbr.base import TrajectoryEvent, DailyCheckInEvent
 from expensecbr.fde import create_daily_rule
@@ -25,10 +26,8 @@ def detect_same_day_multi_city_checkins(rule, events, context):
         return False
     
     # Group checkins by user
-    user_checkins = {}
+    user_checkins = defaultdict(list)
     for event in checkin_events:
-        if event.user_id not in user_checkins:
-            user_checkins[event.user_id] = []
         user_checkins[event.user_id].append(event)
     
     # Default travel speed (km/h) - conservative estimate for high-speed transport
@@ -41,6 +40,11 @@ def detect_same_day_multi_city_checkins(rule, events, context):
     # Minimum distance for suspicion (km)
     min_suspicious_distance = context.get("min_suspicious_distance", 150.0)  # 150 km
     
+    # Bind the rule's helpers once; the pair loop below calls them for every pair
+    is_same_city = rule.is_same_city
+    get_distance = rule.get_distance
+    time_difference = rule.time_difference
+    
     suspicious_patterns = []
     
     # Check each user's check-ins for physically impossible scenarios
@@ -49,14 +53,14 @@ def detect_same_day_multi_city_checkins(rule, events, context):
         if len(user_events) < 2:
             continue
         
-        # Group by date
-        checkins_by_date = {}
+        # Group by date, as (start, end, event) rows so each check-in's time window is
+        # read once here
+        checkins_by_date = defaultdict(list)
         for event in user_events:
             # Get the date (without time)
-            event_date = event.time_window.earliest_start.date()
-            if event_date not in checkins_by_date:
-                checkins_by_date[event_date] = []
-            checkins_by_date[event_date].append(event)
+            time_window = event.time_window
+            start_time = time_window.earliest_start
+            checkins_by_date[start_time.date()].append((start_time, time_window.latest_end, event))
         
         # Check each date with multiple check-ins
         for date, daily_checkins in checkins_by_date.items():
@@ -68,15 +72,15 @@ def detect_same_day_multi_city_checkins(rule, events, context):
             # Compare each pair of check-ins on this date
             for i in range(len(daily_checkins)):
                 for j in range(i + 1, len(daily_checkins)):
-                    event1 = daily_checkins[i]
-                    event2 = daily_checkins[j]
+                    start1, end1, event1 = daily_checkins[i]
+                    start2, end2, event2 = daily_checkins[j]
                     
                     # Skip if events are in the same city
-                    if rule.is_same_city(event1.location, event2.location):
+                    if is_same_city(event1.location, event2.location):
                         continue
                     
                     # Calculate distance between locations
-                    distance = rule.get_distance(event1.location, event2.location)
+                    distance = get_distance(event1.location, event2.location)
                     if distance is None or distance < min_suspicious_distance:
                         continue
                     
@@ -89,21 +93,13 @@ def detect_same_day_multi_city_checkins(rule, events, context):
                     # Check if time windows allow for travel between check-ins
                     # This is complex with uncertain times, so we use the most favorable scenario
                     time_diff_hours = abs(
-                        rule.time_difference(
-                            event1.time_window.latest_end,
-                            event2.time_window.earliest_start,
-                            unit="hours"
-                        )
+                        time_difference(end1, start2, unit="hours")
                     )
                     
                     # If first case is not suspicious, try the reverse order
                     if time_diff_hours >= required_travel_time:
                         time_diff_hours = abs(
-                            rule.time_difference(
-                                event2.time_window.latest_end,
-                                event1.time_window.earliest_start,
-                                unit="hours"
-                            )
+                            time_difference(end2, start1, unit="hours")
                         )
                     
                     # If the time difference is less than the required travel time, this is suspicious
@@ -116,14 +112,14 @@ def detect_same_day_multi_city_checkins(rule, events, context):
                             "required_travel_hours": required_travel_time,
                             "city1": event1.location.city,
                             "city2": event2.location.city,
-                            "time1": event1.time_window.earliest_start,
-                            "time2": event2.time_window.earliest_start
+                            "time1": start1,
+                            "time2": start2
                         })
             
             # If suspicious pairs found for this date, create an alert
             if suspicious_pairs:
                 # Get a reference to one of the events for user info
-                ref_event = daily_checkins[0]
+                ref_event = daily_checkins[0][2]
                 
                 suspicious_patterns.append({
                     "primary_event_id": ref_event.event_id,
@@ -133,7 +129,7 @@ def detect_same_day_multi_city_checkins(rule, events, context):
                     "date": date.strftime("%Y-%m-%d"),
                     "suspicious_pairs": suspicious_pairs,
                     "distinct_cities": list(set([
-                        event.location.city for event in daily_checkins
+                        event.location.city for _, _, event in daily_checkins
                     ])),
                     "checkin_count": len(daily_checkins)
                 })
@@ -155,23 +151,23 @@ def format_same_day_multi_city_checkins_alert(rule, events, extra_data, context)
     cities_str = ", ".join(distinct_cities)
     title = f"Same-Day Multi-City Check-Ins: {cities_str}"
     
-    # Generate detailed description
-    details = (
+    # Generate detailed description, collected in parts and joined once
+    details_parts = [
         f"User {user_name} ({user_id}) from {department} checked in at multiple cities "
         f"on {date} under circumstances that appear physically impossible.\n\n"
-    )
+    ]
     
     # Add details for each suspicious pair
-    details += "Suspicious city pairs:\n"
+    details_parts.append("Suspicious city pairs:\n")
     for idx, pair in enumerate(suspicious_pairs):
-        details += (
+        details_parts.append(
             f"{idx+1}. {pair['city1']} → {pair['city2']}\n"
             f"   Distance: {pair['distance_km']:.1f} km\n"
             f"   Available time: {pair['time_diff_hours']:.1f} hours\n"
             f"   Required travel time: {pair['required_travel_hours']:.1f} hours\n"
         )
     
-    details += (
+    details_parts.append(
         f"\nThis may indicate:\n"
         f"- Check-ins made on behalf of the user by someone else\n"
         f"- Incorrect location data entered in the system\n"
@@ -179,7 +175,7 @@ def format_same_day_multi_city_checkins_alert(rule, events, extra_data, context)
         f"- Fraudulent activity to claim expenses in multiple locations"
     )
     
-    return {"title": title, "details": details}
+    return {"title": title, "details": "".join(details_parts)}
 
 
 # Create the rule using the factory function